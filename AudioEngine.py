@@ -0,0 +1,619 @@
+from collections import deque
+
+import numpy as np
+from PyQt6 import QtCore
+from PyQt6.QtMultimedia import QAudio, QAudioFormat, QAudioSink, QMediaDevices, QMediaPlayer
+
+from LoopCache import LoopCache, blend_seam, render_loop
+from Metronome import CLICK_LENGTH, Metronome
+from TimeStretch import TimeStretcher
+
+
+class _MixDevice(QtCore.QIODevice):
+    """
+    Read-only device the audio sink pulls the mixed stems from
+    """
+
+    def __init__(self, engine, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = engine
+
+    def readData(self, maxlen):
+        return self.engine._render(maxlen)
+
+    def writeData(self, data):
+        return -1
+
+    def bytesAvailable(self):
+        return self.engine.block_size * self.engine.bytes_per_frame + super().bytesAvailable()
+
+    def isSequential(self):
+        return True
+
+
+class _LoopRenderer(QtCore.QThread):
+    """
+    Time-stretches one repetition of a loop in the background
+    """
+
+    rendered = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, key, store, gains, loop, seam_length, seamless, rate, pitch, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key = key
+        self.store = store
+        self.gains = gains
+        self.loop = loop
+        self.seam_length = seam_length
+        self.seamless = seamless
+        self.rate = rate
+        self.pitch = pitch
+
+    def mix(self, start, stop):
+        return self.store.mix(self.gains, start, stop)
+
+    def run(self):
+        start, end = self.loop
+        period = self.mix(start, end)
+        blend_seam(period, start, start, end, self.seam_length, self.mix if self.seamless else None)
+
+        self.rendered.emit(self.key, render_loop(period, self.rate, self.pitch, self.store.sample_rate, self.seamless))
+
+
+class AudioEngine(QtCore.QObject):
+    """
+    Plays all stems of a song through a single audio output. The stems
+    are read from one StemStore and summed with their track gains in one
+    mix step, so they can never drift apart. Mirrors the parts of the
+    QMediaPlayer API the main window uses.
+    """
+
+    positionChanged = QtCore.pyqtSignal(int)
+    durationChanged = QtCore.pyqtSignal(int)
+    playbackStateChanged = QtCore.pyqtSignal(QMediaPlayer.PlaybackState)
+    sourceChanged = QtCore.pyqtSignal()
+    looped = QtCore.pyqtSignal()
+
+    # Frames mixed per pull of the audio sink
+    block_size = 2048
+    position_interval = 30
+    # Seconds blended across the loop seam, 0 for a hard cut
+    loop_crossfade = 0.005
+    # Share of real time the time-stretch may use for each block
+    stretch_budget = 0.5
+
+    def __init__(self, n_tracks, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.n_tracks = n_tracks
+        self.sample_rate = 44100
+        self.n_channels = 2
+        self.bytes_per_frame = self.n_channels * 2
+
+        self._store = None
+        self._n_frames = 0
+        self._gains = np.ones(n_tracks, dtype=np.float32)
+        self._rate = 1.0
+        self._semitones = 0
+
+        # Metronome clicks are added to what comes out of the time-stretch
+        self._click_grid = None
+        self._metronome = None
+        self._click_gain = 0.0
+
+        # The mixed source is read as a stream that wraps around the loop.
+        # _segments maps stream positions back to song frames for the
+        # playhead, since the time-stretch reads ahead of what is heard.
+        self._cursor = 0
+        self._streamed = 0
+        self._segments = deque()
+        # Stream position of the next frame played, clicks are placed by it
+        self._played = 0.0
+        self._at_end = False
+        self._stretching = False
+        self._stretcher = TimeStretcher(self._read_source, self.n_channels, budget=self.stretch_budget)
+        self._loop = None
+        self._loop_delay = 0
+        self._silence = 0
+
+        # While a loop is stretched it plays from a render made ahead of time
+        self._loop_cache = LoopCache()
+        self._renderer = None
+        # Renders of audio that was replaced, only kept to be waited for
+        self._stale_renderers = []
+        self._loop_render = None
+        self._loop_render_key = None
+        self._loop_offset = 0
+        self._loop_entering = False
+
+        self._state = QMediaPlayer.PlaybackState.StoppedState
+
+        self._sink = None
+        self._device = _MixDevice(self)
+        self._device.open(QtCore.QIODevice.OpenModeFlag.ReadOnly)
+
+        self._position_timer = QtCore.QTimer(self)
+        self._position_timer.setInterval(self.position_interval)
+        self._position_timer.timeout.connect(self._emit_position)
+
+    def setSource(self, store):
+        """
+        store: StemStore with one stem per track
+        """
+        if len(store) != self.n_tracks:
+            print(f"Error: AudioEngine expects {self.n_tracks} stems, got {len(store)}")
+            return
+
+        self.stop()
+
+        self._store = store
+        self._n_frames = store.n_frames
+        self.sample_rate = store.sample_rate
+        self._stretcher.sample_rate = store.sample_rate
+        self.setClickGrid(self._click_grid)
+        self._loop = None
+        self._seek(0)
+
+        self._create_sink()
+
+        self.sourceChanged.emit()
+        self.durationChanged.emit(self.duration())
+        self.positionChanged.emit(0)
+
+    def replaceSource(self, store):
+        """
+        Switch to another rendering of the same song, like better separated
+        stems, at the current position and keeping the loop and playback state
+        """
+        if self._store is None or store.sample_rate != self.sample_rate:
+            self.setSource(store)
+            return
+
+        if len(store) != self.n_tracks:
+            print(f"Error: AudioEngine expects {self.n_tracks} stems, got {len(store)}")
+            return
+
+        frame = self._source_frame()
+        duration = self.duration()
+
+        self._store = store
+        self._n_frames = store.n_frames
+        if self._loop is not None:
+            self._loop = (min(self._loop[0], self._n_frames), min(self._loop[1], self._n_frames))
+        self._loop_cache.clear()
+        self._seek(min(frame, self._n_frames))
+
+        # A loop being rendered is of the old audio
+        if self._renderer is not None:
+            renderer = self._renderer
+            renderer.rendered.disconnect(self._loop_rendered)
+            renderer.finished.connect((lambda renderer: lambda: self._stale_renderers.remove(renderer))(renderer))
+            self._stale_renderers.append(renderer)
+            self._renderer = None
+
+        if self.duration() != duration:
+            self.durationChanged.emit(self.duration())
+
+    def updateDuration(self):
+        """
+        Pick up a new length of the current store, like once it's fully decoded
+        """
+        if self._store is None or self._store.n_frames == self._n_frames:
+            return
+
+        self._n_frames = self._store.n_frames
+        if self._loop is not None:
+            self._loop = (min(self._loop[0], self._n_frames), min(self._loop[1], self._n_frames))
+        if self._cursor > self._n_frames:
+            self._seek(self._n_frames)
+
+        self.durationChanged.emit(self.duration())
+
+    def stemStore(self):
+        return self._store
+
+    def play(self):
+        if self._store is None:
+            return
+
+        if self._at_end:
+            self._seek(0)
+
+        if self._sink.state() == QAudio.State.SuspendedState:
+            self._sink.resume()
+        else:
+            self._sink.start(self._device)
+
+        self._set_state(QMediaPlayer.PlaybackState.PlayingState)
+
+    def pause(self):
+        if self._sink is not None:
+            self._sink.suspend()
+        self._set_state(QMediaPlayer.PlaybackState.PausedState)
+
+    def stop(self):
+        if self._sink is not None:
+            self._sink.stop()
+        self._set_state(QMediaPlayer.PlaybackState.StoppedState)
+
+    def playbackState(self):
+        return self._state
+
+    def position(self):
+        return int(self._source_frame() * 1000 / self.sample_rate)
+
+    def _source_frame(self):
+        """
+        Song frame of the audio being output right now
+        """
+        if self._loop_render is not None:
+            return self._loop_render_frame()
+
+        stream_position = self._stretcher.position() if self._stretching else self._streamed
+
+        # Segments stay while a click from them may still be sounding
+        keep_from = min(stream_position, self._played - CLICK_LENGTH * self.sample_rate * self._rate)
+        while len(self._segments) > 1 and self._segments[1][0] <= keep_from:
+            self._segments.popleft()
+
+        if len(self._segments) == 0 or stream_position >= self._streamed:
+            return self._cursor
+
+        index = 0
+        while index + 1 < len(self._segments) and self._segments[index + 1][0] <= stream_position:
+            index += 1
+        stream_start, frame, count = self._segments[index]
+
+        # During the loop delay the playhead waits at the loop end
+        if frame is None:
+            return self._loop[1] if self._loop is not None else self._cursor
+
+        return frame + min(max(stream_position - stream_start, 0), count)
+
+    def _loop_render_frame(self):
+        loop_start, loop_end = self._loop_render_key[1:3]
+        if self._loop_offset >= len(self._loop_render):
+            return loop_end
+        return loop_start + int(self._loop_offset * self._loop_render_key[3])
+
+    def setPosition(self, position):
+        self._seek(int(position * self.sample_rate / 1000))
+        self.positionChanged.emit(self.position())
+
+    def _seek(self, frame):
+        self._cursor = min(max(frame, 0), self._n_frames)
+        self._streamed = 0
+        self._segments.clear()
+        self._played = 0.0
+        self._at_end = False
+        self._silence = 0
+        self._stretcher.reset()
+        self._loop_render = None
+
+    def setLoop(self, start, end):
+        """
+        Wrap playback from end back to start, both in milliseconds
+        """
+        start = min(max(int(start * self.sample_rate / 1000), 0), self._n_frames)
+        end = min(max(int(end * self.sample_rate / 1000), 0), self._n_frames)
+
+        if end <= start:
+            print(f"Error: Loop end must come after loop start. {start} < {end}")
+            return
+
+        self._loop = (start, end)
+
+    def clearLoop(self):
+        self._loop = None
+        self._silence = 0
+
+    def setLoopDelay(self, seconds):
+        self._loop_delay = max(seconds, 0)
+
+    def duration(self):
+        return int(self._n_frames * 1000 / self.sample_rate)
+
+    def playbackRate(self):
+        return self._rate
+
+    def setPlaybackRate(self, rate):
+        self._rate = min(max(float(rate), 0.0), 2.0)
+        self._stretcher.rate = self._rate
+        self._update_stretching()
+
+    def pitch(self):
+        return self._semitones
+
+    def setPitch(self, semitones):
+        """
+        Transpose the whole mix by a number of semitones, at any playback rate
+        """
+        self._semitones = semitones
+        self._stretcher.pitch = 2 ** (semitones / 12)
+        self._update_stretching()
+
+    def _update_stretching(self):
+        # Normal speed and pitch bypass the time-stretch, switching restarts the stream where it's heard
+        stretching = self._rate != 1 or self._semitones != 0
+        if stretching != self._stretching:
+            frame = self._source_frame()
+            self._stretching = stretching
+            self._seek(frame)
+
+    def setClickGrid(self, grid):
+        """
+        grid: BeatGrid the metronome clicks on, None for no clicks
+        """
+        self._click_grid = grid
+        self._metronome = Metronome(grid, self.sample_rate) if grid is not None else None
+
+    def clickVolume(self):
+        return self._click_gain
+
+    def setClickVolume(self, volume):
+        self._click_gain = volume
+
+    def volume(self, track):
+        return float(self._gains[track])
+
+    def setVolume(self, track, volume):
+        self._gains[track] = volume
+
+    def _create_sink(self):
+        if self._sink is not None:
+            self._sink.stop()
+            self._sink.deleteLater()
+
+        audio_format = QAudioFormat()
+        audio_format.setSampleRate(self.sample_rate)
+        audio_format.setChannelCount(self.n_channels)
+        audio_format.setSampleFormat(QAudioFormat.SampleFormat.Int16)
+
+        device = QMediaDevices.defaultAudioOutput()
+        if not device.isFormatSupported(audio_format):
+            print(f"Warning: Audio device may not support {self.sample_rate}Hz 16-bit stereo output")
+
+        self._sink = QAudioSink(device, audio_format, self)
+        self._sink.setBufferSize(self.block_size * self.bytes_per_frame * 2)
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+
+        self._state = state
+
+        if state == QMediaPlayer.PlaybackState.PlayingState:
+            self._position_timer.start()
+        else:
+            self._position_timer.stop()
+
+        self.playbackStateChanged.emit(state)
+        self._emit_position()
+
+    def _emit_position(self):
+        self.positionChanged.emit(self.position())
+
+    def _clicking(self):
+        return self._metronome is not None and self._click_gain > 0
+
+    def _mix(self, start, stop):
+        return self._store.mix(self._gains, start, stop)
+
+    def _add_clicks(self, block, rate):
+        """
+        Add the clicks to block, the next frames played of the stream.
+        Each segment places its beats, so clicks land on both sides of a
+        loop wrap and ring on past it.
+        rate: Stream frames per frame of block
+        """
+        if self._clicking():
+            for stream_start, frame, count in self._segments:
+                if frame is not None:
+                    start = frame + self._played - stream_start
+                    self._metronome.add(block, start, self._click_gain, rate, (frame, frame + count))
+
+        self._played += len(block) * rate
+        return block
+
+    def _seam_length(self):
+        loop_start, loop_end = self._loop
+        length = min(int(self.loop_crossfade * self.sample_rate), (loop_end - loop_start) // 2)
+        if self._loop_delay == 0:
+            length = min(length, loop_start)
+        return length
+
+    def _crossfade(self, block, start):
+        """
+        Blend the end of the loop into the frames leading up to its start,
+        so the audio is continuous when it wraps. With a loop delay the
+        loop fades into silence instead.
+        """
+        mix = self._mix if self._loop_delay == 0 else None
+        blend_seam(block, start, *self._loop, self._seam_length(), mix)
+
+    def _wrap(self):
+        self._cursor = self._loop[0]
+        self._silence = int(self._loop_delay * self.sample_rate * self._rate)
+        QtCore.QTimer.singleShot(0, self.looped.emit)
+
+    def _read_source(self, n_frames):
+        """
+        Next frames of the mixed stems in playback order, wrapping around
+        the loop at the exact frame. Returns fewer frames at the end of the song.
+        """
+        blocks = []
+
+        while n_frames > 0:
+            if self._silence > 0:
+                count = min(n_frames, self._silence)
+                blocks.append(np.zeros((count, self.n_channels), dtype=np.float32))
+                self._segments.append((self._streamed, None, count))
+                self._streamed += count
+                self._silence -= count
+                n_frames -= count
+                continue
+
+            looping = self._loop is not None and self._cursor <= self._loop[1]
+            end = self._loop[1] if looping else self._n_frames
+            count = min(n_frames, end - self._cursor)
+
+            if count <= 0:
+                if not looping:
+                    break
+                self._wrap()
+                continue
+
+            block = self._mix(self._cursor, self._cursor + count)
+            if looping:
+                self._crossfade(block, self._cursor)
+
+            blocks.append(block)
+            self._segments.append((self._streamed, self._cursor, count))
+            self._streamed += count
+            self._cursor += count
+            n_frames -= count
+
+        if len(blocks) == 0:
+            return np.zeros((0, self.n_channels), dtype=np.float32)
+        return np.concatenate(blocks)
+
+    def _loop_key(self):
+        if not self._stretching or self._loop is None or self._store is None:
+            return None
+        return (
+            tuple(self._store.file_names), *self._loop, self._rate, self._semitones,
+            tuple(self._gains.tolist()), self._loop_delay == 0,
+        )
+
+    def _request_loop_render(self, key):
+        if key in self._loop_cache or self._renderer is not None:
+            return
+
+        loop_start, loop_end = self._loop
+        if not self._loop_cache.fits(int((loop_end - loop_start) / self._rate) * self.n_channels * 4):
+            return
+
+        self._renderer = _LoopRenderer(
+            key, self._store, self._gains.copy(), self._loop,
+            self._seam_length(), self._loop_delay == 0, self._rate, self._stretcher.pitch, self,
+        )
+        self._renderer.rendered.connect(self._loop_rendered)
+        self._renderer.finished.connect(self._renderer.deleteLater)
+        self._renderer.start()
+
+    def stopRendering(self):
+        """
+        Wait for the loops that are being rendered, before shutting down
+        """
+        if self._renderer is not None:
+            self._renderer.rendered.disconnect(self._loop_rendered)
+            self._renderer.wait()
+            self._renderer = None
+
+        for renderer in self._stale_renderers:
+            renderer.wait()
+
+    def _loop_rendered(self, key, audio):
+        self._loop_cache.add(key, audio)
+        self._renderer = None
+
+        # The loop or speed may have changed while rendering
+        key = self._loop_key()
+        if key is not None:
+            self._request_loop_render(key)
+
+    def _enter_loop_render(self, key):
+        audio = self._loop_cache.get(key)
+        if audio is None:
+            self._request_loop_render(key)
+            return
+
+        # Only switch over once the playhead is inside the loop
+        frame = self._source_frame()
+        if not self._loop[0] <= frame < self._loop[1]:
+            return
+
+        self._loop_render = audio
+        self._loop_render_key = key
+        self._loop_offset = min(int((frame - self._loop[0]) / self._rate), len(audio))
+        self._loop_entering = True
+
+    def _read_loop_render(self, n_frames):
+        """
+        Next frames of the rendered loop, with the loop delay between repetitions
+        """
+        audio = self._loop_render
+        period = len(audio) + int(self._loop_delay * self.sample_rate)
+        loop_start, loop_end, rate = self._loop_render_key[1:4]
+        blocks = []
+
+        while n_frames > 0:
+            if self._loop_offset >= period:
+                self._loop_offset = 0
+                QtCore.QTimer.singleShot(0, self.looped.emit)
+
+            if self._loop_offset < len(audio):
+                block = audio[self._loop_offset:self._loop_offset + n_frames].copy()
+            else:
+                block = np.zeros((min(n_frames, period - self._loop_offset), self.n_channels), dtype=np.float32)
+
+            # Clicks of this repetition, and of the one before ringing on into it
+            if self._clicking():
+                for offset in (self._loop_offset, self._loop_offset + period):
+                    self._metronome.add(block, loop_start + offset * rate, self._click_gain, rate, (loop_start, loop_end))
+
+            blocks.append(block)
+            self._loop_offset += len(block)
+            n_frames -= len(block)
+
+        return np.concatenate(blocks)
+
+    def _render_frames(self, n_frames):
+        """
+        Next n_frames of output at the current playback rate, fewer at the end of the song.
+        Other rates go through the time-stretch so the pitch stays the same.
+        """
+        if not self._stretching:
+            return self._add_clicks(self._read_source(n_frames), 1)
+
+        # Anything that changes the loop's sound leaves the render where it's heard
+        key = self._loop_key()
+        if self._loop_render is not None and key != self._loop_render_key:
+            self._seek(self._source_frame())
+
+        if self._loop_render is None and key is not None:
+            self._enter_loop_render(key)
+
+        if self._loop_render is None:
+            return self._add_clicks(self._stretcher.process(n_frames), self._rate)
+
+        block = self._read_loop_render(n_frames)
+
+        # Blend over from the live stretch so the switch doesn't click
+        if self._loop_entering:
+            self._loop_entering = False
+            live = self._add_clicks(self._stretcher.process(n_frames), self._rate)
+            length = len(live)
+            t = ((np.arange(length) + 0.5) / length)[:, None].astype(np.float32)
+            block = block.copy()
+            block[:length] = block[:length] * np.sin(t * np.pi / 2) + live * np.cos(t * np.pi / 2)
+
+        return block
+
+    def _render(self, maxlen):
+        n_frames = maxlen // self.bytes_per_frame
+
+        if self._state != QMediaPlayer.PlaybackState.PlayingState or self._store is None or self._rate == 0:
+            return bytes(n_frames * self.bytes_per_frame)
+
+        if n_frames == 0:
+            return b""
+
+        block = self._render_frames(n_frames)
+
+        if len(block) == 0:
+            self._at_end = True
+            QtCore.QTimer.singleShot(0, self.stop)
+            return b""
+
+        return np.clip(block * 32767, -32768, 32767).astype(np.int16).tobytes()
@@ -0,0 +1,278 @@
+import json
+import os
+import threading
+from os import path
+
+import numpy as np
+
+
+ANALYSIS_RATE = 11025
+FRAME_SIZE = 512
+HOP_SIZE = 128
+# Spectral frames analysed per FFT batch
+BATCH_SIZE = 2048
+# Bins below this frequency make up the low band, mostly kick drum
+LOW_BAND = 150
+
+MIN_BPM = 30
+MAX_BPM = 300
+# Tempos near this are preferred when a song fits several
+PRIOR_BPM = 120
+BEATS_PER_BAR = 4
+# How strongly beats are kept to the tempo, against following the onsets
+TIGHTNESS = 100
+
+BEATS_FILE_NAME = "beats.json"
+BEATS_VERSION = 1
+
+
+class BeatGrid:
+    """
+    Beat times of a song in seconds, every beats_per_bar beats
+    from downbeat starts a bar
+    """
+
+    def __init__(self, beats, bpm, downbeat=0, beats_per_bar=BEATS_PER_BAR):
+        self.beats = np.asarray(beats, dtype=np.float64)
+        self.bpm = bpm
+        self.downbeat = downbeat
+        self.beats_per_bar = beats_per_bar
+
+    @classmethod
+    def from_tempo(cls, bpm, offset, duration, beats_per_bar=BEATS_PER_BAR):
+        """
+        Evenly spaced beats over duration seconds
+        offset: Time of a downbeat in milliseconds
+        """
+        period = 60 / bpm
+        first = offset / 1000 % period
+        beats = np.arange(first, duration, period)
+        downbeat = int(round((offset / 1000 - first) / period)) % beats_per_bar
+        return cls(beats, bpm, downbeat, beats_per_bar)
+
+    def __len__(self):
+        return len(self.beats)
+
+    def snap(self, time, bars=False):
+        """
+        Nearest beat to time in seconds, or nearest downbeat with bars
+        """
+        times = self.downbeats() if bars else self.beats
+        if len(times) == 0:
+            return time
+
+        index = int(np.searchsorted(times, time))
+        neighbours = times[max(index - 1, 0):index + 1]
+        return float(neighbours[np.argmin(np.abs(neighbours - time))])
+
+    def downbeats(self):
+        return self.beats[self.downbeat::self.beats_per_bar]
+
+    def offset(self):
+        """
+        Time of the first downbeat in milliseconds, brought within the first bar
+        """
+        if len(self.beats) <= self.downbeat:
+            return 0
+
+        bar = 60000 * self.beats_per_bar / self.bpm
+        return int(round(self.beats[self.downbeat] * 1000 % bar))
+
+
+def _mono(stem, factor, chunk_size=1 << 20):
+    """
+    Stem mixed down to one channel and reduced to about ANALYSIS_RATE by averaging
+    """
+    n_frames = stem.n_frames // factor
+    out = np.empty(n_frames, dtype=np.float32)
+
+    for start in range(0, n_frames, chunk_size):
+        stop = min(start + chunk_size, n_frames)
+        chunk = np.asarray(stem.read(start * factor, stop * factor), dtype=np.float32)
+        out[start:stop] = chunk.reshape(stop - start, factor * stem.n_channels).mean(axis=1)
+
+    return out * np.float32(stem.scale)
+
+
+def onset_envelope(samples, sample_rate):
+    """
+    Spectral flux of samples: how much louder each spectral frame got than
+    the one before, summed over all bins and over the low band alone
+    Returns both envelopes, one value per HOP_SIZE samples.
+    """
+    # Centred frames, so frame i belongs to sample i * HOP_SIZE
+    padded = np.pad(samples, FRAME_SIZE // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, FRAME_SIZE)[::HOP_SIZE]
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    n_low = max(int(LOW_BAND * FRAME_SIZE / sample_rate), 1)
+
+    flux = np.zeros(len(frames), dtype=np.float32)
+    low_flux = np.zeros(len(frames), dtype=np.float32)
+    previous = None
+
+    for start in range(0, len(frames), BATCH_SIZE):
+        spectrum = np.abs(np.fft.rfft(frames[start:start + BATCH_SIZE] * window, axis=1))
+        spectrum = np.log1p(100 * spectrum).astype(np.float32)
+
+        if previous is None:
+            previous = spectrum[:1]
+        rise = np.maximum(np.diff(spectrum, axis=0, prepend=previous), 0)
+        previous = spectrum[-1:]
+
+        flux[start:start + len(spectrum)] = rise.sum(axis=1)
+        low_flux[start:start + len(spectrum)] = rise[:, :n_low].sum(axis=1)
+
+    # Only rises above the local average count as onsets
+    width = max(int(sample_rate / HOP_SIZE / 4), 1)
+    kernel = np.ones(width, dtype=np.float32) / width
+    flux = np.maximum(flux - np.convolve(flux, kernel, mode="same"), 0)
+
+    return flux, low_flux
+
+
+def estimate_period(onsets, frame_rate):
+    """
+    Beat period in onset frames, from the autocorrelation of the onset
+    envelope weighted towards PRIOR_BPM
+    """
+    centred = onsets - onsets.mean()
+    fft_size = 1 << int(np.ceil(np.log2(len(centred) * 2)))
+    spectrum = np.fft.rfft(centred, fft_size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), fft_size)
+
+    first = max(int(60 * frame_rate / MAX_BPM), 1)
+    last = min(int(np.ceil(60 * frame_rate / MIN_BPM)), len(onsets) - 2)
+    if last <= first:
+        return 60 * frame_rate / PRIOR_BPM
+
+    lags = np.arange(first, last + 1)
+    bpms = 60 * frame_rate / lags
+    weights = np.exp(-0.5 * np.log2(bpms / PRIOR_BPM) ** 2)
+    best = first + int(np.argmax(autocorrelation[first:last + 1] * weights))
+
+    # Parabolic interpolation between the neighbouring lags
+    below, peak, above = autocorrelation[best - 1:best + 2]
+    curvature = below - 2 * peak + above
+    if curvature < 0:
+        return best + 0.5 * (below - above) / curvature
+    return float(best)
+
+
+def track_beats(onsets, period):
+    """
+    Onset frames of the beats, by dynamic programming: every frame scores its
+    onset strength plus the best earlier beat, penalised for straying from period
+    """
+    onsets = onsets / max(onsets.std(), 1e-9)
+    n_frames = len(onsets)
+
+    nearest = max(int(round(period / 2)), 1)
+    furthest = max(int(round(period * 2)), nearest + 1)
+    # Penalties for the earlier beat furthest .. nearest frames back
+    intervals = np.arange(furthest, nearest - 1, -1)
+    penalties = -TIGHTNESS * np.log(intervals / period) ** 2
+
+    score = onsets.astype(np.float64)
+    previous = np.full(n_frames, -1, dtype=np.int64)
+
+    for frame in range(nearest, n_frames):
+        first = max(frame - furthest, 0)
+        candidates = score[first:frame - nearest + 1] + penalties[len(penalties) - (frame - nearest + 1 - first):]
+        best = int(np.argmax(candidates))
+
+        if candidates[best] > 0:
+            score[frame] += candidates[best]
+            previous[frame] = first + best
+
+    # The chain ends at the best scoring frame within the last beat
+    tail = max(n_frames - furthest, 0)
+    frame = tail + int(np.argmax(score[tail:]))
+
+    beats = []
+    while frame >= 0:
+        beats.append(frame)
+        frame = previous[frame]
+
+    return np.array(beats[::-1], dtype=np.int64)
+
+
+def detect_beats(stem):
+    """
+    Beat grid of a song from its drums stem
+    """
+    factor = max(int(round(stem.sample_rate / ANALYSIS_RATE)), 1)
+    sample_rate = stem.sample_rate / factor
+    frame_rate = sample_rate / HOP_SIZE
+
+    onsets, low_onsets = onset_envelope(_mono(stem, factor), sample_rate)
+    if len(onsets) < 2 or not onsets.any():
+        return BeatGrid([], PRIOR_BPM)
+
+    period = estimate_period(onsets, frame_rate)
+    beats = track_beats(onsets, period)
+
+    # The bar starts on the beat with the most kick drum
+    strengths = [low_onsets[beats[phase::BEATS_PER_BAR]].mean() for phase in range(min(BEATS_PER_BAR, len(beats)))]
+    downbeat = int(np.argmax(strengths))
+
+    return BeatGrid(beats / frame_rate, float(60 * frame_rate / period), downbeat)
+
+
+def beats_path(separated_dir):
+    return path.join(separated_dir, BEATS_FILE_NAME)
+
+
+def load_beats(stem, separated_dir):
+    """
+    Cached beat grid of a song, None if it's missing or was made from a different stem
+    """
+    try:
+        with open(beats_path(separated_dir), "r") as f:
+            beats = json.load(f)
+        stat = os.stat(stem.file_name)
+    except (OSError, ValueError):
+        return None
+
+    if beats.get("version") != BEATS_VERSION:
+        return None
+    if beats.get("size") != stat.st_size or beats.get("mtime") != stat.st_mtime_ns:
+        return None
+
+    return BeatGrid(beats["beats"], beats["bpm"], beats["downbeat"], beats["beats_per_bar"])
+
+
+def save_beats(stem, separated_dir, grid):
+    file_name = beats_path(separated_dir)
+
+    try:
+        stat = os.stat(stem.file_name)
+        beats = {
+            "version": BEATS_VERSION,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "bpm": grid.bpm,
+            "downbeat": grid.downbeat,
+            "beats_per_bar": grid.beats_per_bar,
+            "beats": [round(beat, 4) for beat in grid.beats.tolist()],
+        }
+
+        temp_file = f"{file_name}.{threading.get_ident()}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(beats, f)
+        os.replace(temp_file, file_name)
+    except OSError as e:
+        print(f"Warning: Could not write beat grid {file_name}. {e}")
+
+
+def load_or_detect(stem, separated_dir):
+    """
+    Beat grid of a song, read from the stem directory when it's up to date
+    stem: The drums stem
+    """
+    grid = load_beats(stem, separated_dir)
+    if grid is not None:
+        return grid
+
+    grid = detect_beats(stem)
+    save_beats(stem, separated_dir, grid)
+    return grid
@@ -0,0 +1,21 @@
+from PyQt6 import QtCore
+
+import BeatTracker
+
+
+class BeatWorker(QtCore.QThread):
+    """
+    Finds the beats of a song off the GUI thread, or reads them
+    from the beat grid cached next to its stems
+    """
+
+    detected = QtCore.pyqtSignal(object)
+
+    def __init__(self, stem, separated_dir, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.stem = stem
+        self.separated_dir = separated_dir
+
+    def run(self):
+        self.detected.emit(BeatTracker.load_or_detect(self.stem, self.separated_dir))
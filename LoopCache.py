@@ -0,0 +1,121 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from TimeStretch import TimeStretcher
+
+
+DEFAULT_BUDGET = 256 * 1024**2
+# Seconds blended where a rendered loop wraps into its own start
+RENDER_CROSSFADE = 0.01
+
+
+def blend_seam(block, start, loop_start, loop_end, length, mix=None):
+    """
+    Fade out the last length frames of a loop found in block, which starts at
+    frame start. With mix the frames leading up to the loop start are faded in
+    over them, so the audio is continuous when it wraps.
+    mix: Function returning the mixed source between two frames
+    """
+    fade_start = loop_end - length
+    first = max(start, fade_start)
+    last = start + len(block)
+    if length <= 0 or first >= last:
+        return
+
+    t = ((np.arange(first, last) - fade_start + 0.5) / length)[:, None].astype(np.float32)
+    block[first - start:] *= np.cos(t * np.pi / 2)
+
+    if mix is not None:
+        offset = loop_end - loop_start
+        block[first - start:] += np.sin(t * np.pi / 2) * mix(first - offset, last - offset)
+
+
+def render_loop(period, rate, pitch, sample_rate, seamless):
+    """
+    Time-stretch one repetition of a loop ahead of time
+    period: The loop as it sounds at normal speed, (frames, channels)
+    seamless: The loop wraps straight into its start, so the render has to as well.
+              Otherwise it's followed by a delay and only has to fade out.
+    """
+    n_channels = period.shape[1]
+    length = int(round(len(period) / rate))
+
+    if seamless:
+        # Stretch a few repetitions and take the middle one, so the
+        # stretch has settled and runs on past the seam on both sides
+        source = np.concatenate((period, period, period))
+        skip = length
+        fade = min(int(RENDER_CROSSFADE * sample_rate), length // 2)
+    else:
+        padding = np.zeros((len(period), n_channels), dtype=np.float32)
+        source = np.concatenate((padding, period, padding))
+        skip = int(round(len(padding) / rate))
+        fade = 0
+
+    position = 0
+
+    def read(n_frames):
+        nonlocal position
+        frames = source[position:position + n_frames]
+        position += len(frames)
+        return frames
+
+    stretcher = TimeStretcher(read, n_channels)
+    stretcher.rate = rate
+    stretcher.pitch = pitch
+    stretcher.process(skip)
+    audio = stretcher.process(length + fade)
+
+    if len(audio) < length + fade:
+        audio = np.concatenate((audio, np.zeros((length + fade - len(audio), n_channels), dtype=np.float32)))
+
+    # What follows the repetition is blended into its start
+    if fade > 0:
+        t = ((np.arange(fade) + 0.5) / fade)[:, None].astype(np.float32)
+        audio[:fade] = audio[:fade] * np.sin(t * np.pi / 2) + audio[length:length + fade] * np.cos(t * np.pi / 2)
+
+    return audio[:length]
+
+
+class LoopCache:
+    """
+    Recently rendered loops, held in memory up to a budget in bytes.
+    The least recently played render is dropped first.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.renders = OrderedDict()
+        self.used = 0
+
+    def __contains__(self, key):
+        return key in self.renders
+
+    def get(self, key):
+        audio = self.renders.get(key)
+        if audio is not None:
+            self.renders.move_to_end(key)
+        return audio
+
+    def fits(self, n_bytes):
+        # A single render may not push everything else out
+        return n_bytes <= self.budget // 2
+
+    def add(self, key, audio):
+        if not self.fits(audio.nbytes):
+            return
+
+        if key in self.renders:
+            self.used -= self.renders.pop(key).nbytes
+
+        self.renders[key] = audio
+        self.used += audio.nbytes
+
+        while self.used > self.budget:
+            _, evicted = self.renders.popitem(last=False)
+            self.used -= evicted.nbytes
+
+    def clear(self):
+        self.renders.clear()
+        self.used = 0
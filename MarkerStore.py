@@ -0,0 +1,124 @@
+import bisect
+
+
+class Marker:
+    """
+    A named position in a song, in milliseconds
+    kind: What made the marker, "checkpoint", "marker" or "bar"
+    slot: Checkpoint button the marker belongs to, if any
+    """
+
+    __slots__ = ("position", "name", "color", "kind", "slot")
+
+    def __init__(self, position, name="", color="#cdd6f4", kind="marker", slot=None):
+        self.position = position
+        self.name = name
+        self.color = color
+        self.kind = kind
+        self.slot = slot
+
+
+class MarkerStore:
+    """
+    The markers of a song sorted by position. Navigation and finding the
+    markers in view are binary searches, so songs can carry hundreds of
+    them, like a marker on every bar.
+    """
+
+    def __init__(self):
+        self.positions = []
+        self.markers = []
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.markers)
+
+    def __iter__(self):
+        return iter(self.markers)
+
+    def add(self, marker):
+        # Markers at the same position keep the order they were added in
+        index = bisect.bisect_right(self.positions, marker.position)
+        self.positions.insert(index, marker.position)
+        self.markers.insert(index, marker)
+        if marker.slot is not None:
+            self.slots[marker.slot] = marker
+        return marker
+
+    def extend(self, markers):
+        """
+        Add many markers with a single sort
+        """
+        markers = list(markers)
+        self.markers.extend(markers)
+        self.markers.sort(key=lambda marker: marker.position)
+        self.positions = [marker.position for marker in self.markers]
+        self.slots.update((marker.slot, marker) for marker in markers if marker.slot is not None)
+
+    def remove(self, marker):
+        """
+        Returns False if the marker isn't in the store
+        """
+        index = bisect.bisect_left(self.positions, marker.position)
+        while index < len(self.markers) and self.markers[index].position == marker.position and self.markers[index] is not marker:
+            index += 1
+
+        if index == len(self.markers) or self.markers[index] is not marker:
+            return False
+
+        del self.positions[index]
+        del self.markers[index]
+        if marker.slot is not None:
+            del self.slots[marker.slot]
+        return True
+
+    def remove_kind(self, kind):
+        self.markers = [marker for marker in self.markers if marker.kind != kind]
+        self.positions = [marker.position for marker in self.markers]
+        self.slots = {slot: marker for slot, marker in self.slots.items() if marker.kind != kind}
+
+    def clear(self):
+        self.positions = []
+        self.markers = []
+        self.slots = {}
+
+    def has_kind(self, kind):
+        return any(marker.kind == kind for marker in self.markers)
+
+    def slot(self, slot):
+        """
+        Marker of a checkpoint button, None if it isn't set
+        """
+        return self.slots.get(slot)
+
+    def previous(self, position, threshold=0):
+        """
+        Last marker at least threshold milliseconds before position
+        """
+        index = bisect.bisect_right(self.positions, position - threshold)
+        return self.markers[index - 1] if index > 0 else None
+
+    def next(self, position, threshold=0):
+        """
+        First marker at least threshold milliseconds after position
+        """
+        index = bisect.bisect_left(self.positions, position + threshold)
+        return self.markers[index] if index < len(self.markers) else None
+
+    def nearest(self, position, threshold):
+        """
+        Marker closest to position, None if none is within threshold milliseconds
+        """
+        index = bisect.bisect_left(self.positions, position)
+        candidates = self.markers[max(index - 1, 0):index + 1]
+        if len(candidates) == 0:
+            return None
+
+        marker = min(candidates, key=lambda marker: abs(marker.position - position))
+        return marker if abs(marker.position - position) <= threshold else None
+
+    def span(self, start, stop):
+        """
+        Index range of the markers between two positions
+        """
+        return bisect.bisect_left(self.positions, start), bisect.bisect_right(self.positions, stop)
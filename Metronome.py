@@ -0,0 +1,55 @@
+import numpy as np
+
+
+CLICK_LENGTH = 0.03
+CLICK_FREQUENCY = 1000
+ACCENT_FREQUENCY = 1600
+CLICK_DECAY = 150
+
+
+def click_sound(frequency, sample_rate, length=CLICK_LENGTH):
+    """
+    Short sine blip with a sharp attack and exponential decay
+    """
+    t = np.arange(int(length * sample_rate)) / sample_rate
+    return (np.sin(2 * np.pi * frequency * t) * np.exp(-t * CLICK_DECAY)).astype(np.float32)
+
+
+class Metronome:
+    """
+    Clicks on every beat of a beat grid, with an accent on the downbeats.
+    They're placed by song frame after the time-stretch, so they follow
+    loops and speed changes like the song does but always sound the same.
+    """
+
+    def __init__(self, grid, sample_rate):
+        self.frames = np.round(grid.beats * sample_rate).astype(np.int64)
+        self.accents = (np.arange(len(self.frames)) - grid.downbeat) % grid.beats_per_bar == 0
+
+        self.click = click_sound(CLICK_FREQUENCY, sample_rate)
+        self.accent = click_sound(ACCENT_FREQUENCY, sample_rate)
+
+    def add(self, block, start, gain, rate=1.0, window=None):
+        """
+        Add the clicks sounding within block to it
+        start: Song frame played at the first frame of block, may be fractional
+        rate: Song frames played per frame of block
+        window: Song frames (first, stop) the beats are taken from, e.g. a part of
+                the song that played up to a loop wrap. Everything if None.
+        """
+        first = start - len(self.click) * rate
+        stop = start + len(block) * rate
+        if window is not None:
+            first = max(first, window[0] - 1)
+            stop = min(stop, window[1])
+
+        first = np.searchsorted(self.frames, first, side="right")
+        last = np.searchsorted(self.frames, stop)
+
+        for frame, accent in zip(self.frames[first:last], self.accents[first:last]):
+            sound = self.accent if accent else self.click
+            offset = int(round((frame - start) / rate))
+            begin = max(offset, 0)
+            end = min(offset + len(sound), len(block))
+            if begin < end:
+                block[begin:end] += np.float32(gain) * sound[begin - offset:end - offset, None]
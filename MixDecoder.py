@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+from PyQt6 import QtCore
+
+import Separation
+from StemStore import MixStore
+
+
+class MixDecoder(QtCore.QThread):
+    """
+    Decodes the original file of a song into a MixStore block by block,
+    so it can play while the rest is still being decoded. The audio is
+    resampled to the rate of the stems, so they can take over seamlessly.
+    """
+
+    failed = QtCore.pyqtSignal(str)
+
+    # Frames read from the file at a time
+    block_size = 65536
+
+    def __init__(self, file_name, n_stems, sample_rate=Separation.SAMPLE_RATE, *args, **kwargs):
+        """
+        Raises ImportError without soundfile, RuntimeError or OSError if the file can't be decoded
+        """
+        super().__init__(*args, **kwargs)
+
+        # Only needed once a song is opened
+        import soundfile
+
+        self._file = soundfile.SoundFile(file_name)
+        self._ratio = self._file.samplerate / sample_rate
+        self._previous = None
+        self._consumed = 0
+
+        # Some formats don't know their length up front, the store grows as needed.
+        # Rounded up with a frame to spare, so resampling never outgrows the store.
+        n_frames = self._file.frames if 0 < self._file.frames < 1 << 40 else 0
+        self.store = MixStore(file_name, n_stems, sample_rate, math.ceil(n_frames / self._ratio) + 1 if n_frames > 0 else 0)
+
+    def run(self):
+        try:
+            while not self.isInterruptionRequested():
+                block = self._file.read(self.block_size, dtype="float32", always_2d=True)
+                if len(block) == 0:
+                    break
+
+                # Mono is played on both sides, anything past stereo is dropped
+                block = np.repeat(block, 2, axis=1) if block.shape[1] == 1 else block[:, :2]
+                block = self._resample(block)
+                self.store.append(np.clip(block * 32768, -32768, 32767).astype(np.int16))
+
+            self.store.finish()
+        except RuntimeError as e:
+            self.failed.emit(f"Could not decode {self.store.file_name}. {e}")
+        finally:
+            self._file.close()
+
+    def _resample(self, block):
+        """
+        Linear interpolation of block to the rate of the store, continuing
+        from the last frame of the block before
+        """
+        if self._ratio == 1:
+            return block
+
+        frames = block if self._previous is None else np.concatenate((self._previous, block))
+        first = self._consumed - (len(frames) - len(block))
+        self._consumed += len(block)
+        self._previous = block[-1:]
+
+        if len(frames) < 2:
+            return frames[:0]
+
+        # Output frames that fall at or before the last frame read
+        stop = math.floor((self._consumed - 1) / self._ratio) + 1
+        positions = np.arange(self.store.decoded, stop) * self._ratio - first
+        index = np.minimum(positions.astype(np.int64), len(frames) - 2)
+        fraction = (positions - index).astype(np.float32)[:, None]
+
+        return frames[index] * (1 - fraction) + frames[index + 1] * fraction
@@ -210,6 +210,17 @@ class MixerWidget(QtWidgets.QWidget):
     def value(self):
         return self._dial.value()
 
+    def setValue(self, value):
+        self._dial.setValue(value)
+
+    def setMuted(self, muted):
+        if muted != self.muted:
+            self._toggle_mute()
+
+    def setSoloed(self, soloed):
+        if soloed != self.soloed:
+            self._toggle_solo()
+
     def setMuteShortcut(self, shortcut):
         self.button_mute.setShortcut(shortcut)
 
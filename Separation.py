@@ -0,0 +1,210 @@
+import os
+import re
+import sys
+from os import path
+
+
+STEMS = ["drums", "bass", "vocals", "other"]
+DEFAULT_MODEL = "htdemucs_ft"
+DEFAULT_PROFILE = "quality"
+DEFAULT_OUTPUT_DIR = "separated"
+# Rate demucs writes its stems at
+SAMPLE_RATE = 44100
+
+# File format of the stems and the demucs arguments that write it.
+# FLAC is lossless at about half the size of WAV, MP3 is a quarter of that.
+STEM_FORMATS = {
+    "wav": [],
+    "flac": ["--flac"],
+    "mp3": ["--mp3", "--mp3-bitrate", "320"],
+}
+DEFAULT_STEM_FORMAT = "flac"
+AUDIO_EXTENSIONS = [".mp3", ".wav", ".ogg", ".opus", ".m4a", ".flac"]
+
+# Rough resources a single demucs process needs to run comfortably
+JOB_MEMORY_BYTES = 3 * 1024**3
+JOB_CPU_CORES = 2
+
+# demucs defaults, options left at these aren't passed
+DEFAULT_SHIFTS = 1
+DEFAULT_OVERLAP = 0.25
+
+# Number of models in a demucs bag, each one produces its own progress bar
+MODEL_PASSES = {
+    "htdemucs_ft": 4,
+    "mdx": 4,
+    "mdx_extra": 4,
+    "mdx_q": 4,
+    "mdx_extra_q": 4,
+}
+
+_progress_pattern = re.compile(r"(\d{1,3})%\|")
+
+
+class SeparationProfile:
+    """
+    demucs settings trading separation quality against speed
+    shifts: Passes over randomly shifted audio that are averaged, each one costs a full pass
+    segment: Seconds of audio the model works on at once, None for the model's own length
+    overlap: Share of each segment that overlaps the next one
+    """
+
+    def __init__(self, name, model, shifts=DEFAULT_SHIFTS, segment=None, overlap=DEFAULT_OVERLAP):
+        self.name = name
+        self.model = model
+        self.shifts = shifts
+        self.segment = segment
+        self.overlap = overlap
+
+    def options(self):
+        """
+        demucs arguments of the settings that change the stems, cache keys are made from these
+        """
+        options = []
+        if self.shifts != DEFAULT_SHIFTS:
+            options += ["--shifts", str(self.shifts)]
+        if self.segment is not None:
+            options += ["--segment", str(self.segment)]
+        if self.overlap != DEFAULT_OVERLAP:
+            options += ["--overlap", str(self.overlap)]
+        return options
+
+    def replace(self, model=None, shifts=None, segment=None, overlap=None):
+        """
+        Copy of the profile with some of its settings changed
+        """
+        return SeparationProfile(
+            self.name,
+            model if model is not None else self.model,
+            shifts if shifts is not None else self.shifts,
+            segment if segment is not None else self.segment,
+            overlap if overlap is not None else self.overlap,
+        )
+
+
+PROFILES = {
+    # A single model with less overlap between segments, several times faster
+    "preview": SeparationProfile("preview", "htdemucs", overlap=0.1),
+    "quality": SeparationProfile("quality", DEFAULT_MODEL),
+}
+
+
+def separated_dir(name, model=DEFAULT_MODEL, out_dir=DEFAULT_OUTPUT_DIR):
+    return f"{out_dir}/{model}/{name}/"
+
+
+def stem_paths(directory):
+    """
+    Stem files of a directory in the format they were written in, the
+    default format if there are none yet
+    """
+    for stem_format in STEM_FORMATS:
+        paths = [path.join(directory, f"{stem}.{stem_format}") for stem in STEMS]
+        if all(path.isfile(stem) for stem in paths):
+            return paths
+
+    return [path.join(directory, f"{stem}.{DEFAULT_STEM_FORMAT}") for stem in STEMS]
+
+
+def is_separated(directory):
+    """
+    A directory only counts as separated once every stem is written,
+    a cancelled or crashed run can leave it partially filled.
+    """
+    return all(path.isfile(stem) for stem in stem_paths(directory))
+
+
+def demucs_command(file_name, name, model=DEFAULT_MODEL, out_dir=DEFAULT_OUTPUT_DIR, options=(), jobs=1, stem_format=DEFAULT_STEM_FORMAT):
+    """
+    Command line that runs demucs in its own interpreter process
+    name: Directory the stems are written to, see separated_dir
+    options: Extra demucs arguments
+    jobs: Segments of the song separated in parallel
+    stem_format: One of STEM_FORMATS
+    """
+    return [
+        sys.executable, "-m", "demucs.separate",
+        "-n", model,
+        "-o", out_dir,
+        "--filename", f"{name}/{{stem}}.{{ext}}",
+        *options,
+        *STEM_FORMATS[stem_format],
+        *(["-j", str(jobs)] if jobs > 1 else []),
+        file_name,
+    ]
+
+
+def find_audio_files(directory):
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if path.splitext(name)[1].lower() in AUDIO_EXTENSIONS:
+                files.append(path.join(root, name))
+    return files
+
+
+def available_memory():
+    """
+    Available physical memory in bytes, or None if it can't be determined
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def max_concurrent_jobs():
+    """
+    Number of demucs processes that fit the cores and memory of this machine
+    """
+    cores = os.cpu_count() or 1
+    jobs = max(1, cores // JOB_CPU_CORES)
+
+    memory = available_memory()
+    if memory is not None:
+        jobs = min(jobs, max(1, memory // JOB_MEMORY_BYTES))
+
+    return int(jobs)
+
+
+def split_cores(n_processes=1, reserved_cores=0):
+    """
+    Parallel segment jobs and threads per job for each of n_processes
+    demucs processes running at the same time. Every segment job holds
+    its own copy of the model, so they're limited like processes are.
+    reserved_cores: Cores kept free for other work, like playback
+    """
+    cores = max(1, (os.cpu_count() or 1) - reserved_cores)
+    jobs = max(1, min(max_concurrent_jobs(), cores // JOB_CPU_CORES) // n_processes)
+    threads = max(1, cores // (jobs * n_processes))
+    return jobs, threads
+
+
+class ProgressParser:
+    """
+    Turns the tqdm output of demucs into a single 0-100 percentage
+    spanning all of the passes of a model bag and its shifts.
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, shifts=DEFAULT_SHIFTS):
+        # Every shift runs every model of the bag again
+        self.passes = MODEL_PASSES.get(model, 1) * max(shifts, 1)
+        self.current_pass = 0
+        self.last_percent = 0
+
+    def feed(self, text):
+        """
+        Returns the overall progress if the text contained any, otherwise None
+        """
+        matches = _progress_pattern.findall(text)
+        if not matches:
+            return None
+
+        for match in matches:
+            percent = min(int(match), 100)
+            # tqdm restarts from zero for each model of the bag
+            if percent < self.last_percent:
+                self.current_pass = min(self.current_pass + 1, self.passes - 1)
+            self.last_percent = percent
+
+        return int((self.current_pass * 100 + self.last_percent) / self.passes)
@@ -0,0 +1,180 @@
+import json
+import os
+from os import path
+
+from PyQt6 import QtCore
+
+import Separation
+from SeparationWorker import SeparationJob
+
+
+class SeparationQueue(QtCore.QObject):
+    """
+    Batch separation of many songs with a bounded number of concurrent
+    demucs processes. The queue is saved to disk after every change so
+    an interrupted batch resumes on the next start.
+    """
+
+    queueChanged = QtCore.pyqtSignal()
+    # File name, cache key and directory of the stems
+    songSeparated = QtCore.pyqtSignal((str, str, str))
+
+    state_file = f"{Separation.DEFAULT_OUTPUT_DIR}/queue.json"
+
+    def __init__(self, cache, max_jobs=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.cache = cache
+        self.max_jobs = max_jobs if max_jobs is not None else Separation.max_concurrent_jobs()
+        self.entries = []
+        self.jobs = {}
+        # Cache keys being separated outside the queue, their entries wait
+        self.reserved = set()
+
+        self._load()
+
+    def addFiles(self, file_names):
+        known = {entry["file"] for entry in self.entries}
+
+        for file_name in file_names:
+            file_name = path.abspath(file_name)
+            if file_name in known or not path.isfile(file_name):
+                continue
+            self.entries.append({"file": file_name, "profile": Separation.DEFAULT_PROFILE, "state": "pending"})
+            known.add(file_name)
+
+        self._save()
+        self.queueChanged.emit()
+        self._schedule()
+
+    def addDirectory(self, directory):
+        self.addFiles(Separation.find_audio_files(directory))
+
+    def cancel(self):
+        """
+        Stop the batch, songs that aren't separated yet are taken off the queue
+        """
+        self.entries = [entry for entry in self.entries if entry["state"] in ("done", "failed")]
+        for job in list(self.jobs.values()):
+            job.cancel()
+
+        self._save()
+        self.queueChanged.emit()
+
+    def clearFinished(self):
+        self.entries = [entry for entry in self.entries if entry["state"] not in ("done", "failed")]
+        self._save()
+        self.queueChanged.emit()
+
+    def count(self, state=None):
+        if state is None:
+            return len(self.entries)
+        return sum(1 for entry in self.entries if entry["state"] == state)
+
+    def isActive(self):
+        return len(self.jobs) > 0
+
+    def job(self, key):
+        """
+        The running job separating the stems of key, None if there is none
+        """
+        for job in self.jobs.values():
+            if job.key == key:
+                return job
+        return None
+
+    def reserve(self, key):
+        self.reserved.add(key)
+
+    def release(self, key):
+        if key not in self.reserved:
+            return
+
+        self.reserved.remove(key)
+        self._schedule()
+
+    def _schedule(self):
+        # Each job gets an even share of the cores
+        threads = max(1, (os.cpu_count() or 1) // self.max_jobs)
+
+        for entry in self.entries:
+            if len(self.jobs) >= self.max_jobs:
+                break
+            if entry["state"] != "pending":
+                continue
+
+            if not path.isfile(entry["file"]):
+                entry["state"] = "failed"
+                continue
+
+            profile = self._profile(entry)
+            key, _, cached = self.cache.lookup(entry["file"], profile.model, profile.options())
+            if cached:
+                entry["state"] = "done"
+                continue
+            if key in self.reserved:
+                continue
+
+            job = SeparationJob(entry["file"], key, profile, threads=threads, parent=self)
+            job.finished.connect((lambda entry: lambda directory: self._job_finished(entry, directory))(entry))
+            job.failed.connect((lambda entry: lambda message: self._job_failed(entry, message))(entry))
+            entry["state"] = "running"
+            self.jobs[entry["file"]] = job
+            job.start()
+
+        self._save()
+        self.queueChanged.emit()
+
+    def _job_finished(self, entry, separated_dir):
+        job = self.jobs[entry["file"]]
+        self.cache.add(job.key, job.model)
+        self._finish_job(entry, "done")
+        self.songSeparated.emit(entry["file"], job.key, separated_dir)
+
+    def _job_failed(self, entry, message):
+        if not self.jobs[entry["file"]].isCancelled():
+            print(f"Error: Separating {entry['file']} failed. {message}")
+        self._finish_job(entry, "failed")
+
+    def _finish_job(self, entry, state):
+        job = self.jobs.pop(entry["file"])
+        job.deleteLater()
+
+        # A cancelled job was taken off the queue already
+        if job.isCancelled():
+            return
+
+        entry["state"] = state
+        self._schedule()
+
+    def _profile(self, entry):
+        # Queues saved before profiles existed only name the default model
+        return Separation.PROFILES.get(entry.get("profile"), Separation.PROFILES[Separation.DEFAULT_PROFILE])
+
+    def _load(self):
+        if not path.isfile(self.state_file):
+            return
+
+        try:
+            with open(self.state_file) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            print(f"Error: Could not read separation queue {self.state_file}")
+            self.entries = []
+
+        # Jobs that were running when the app closed start over
+        for entry in self.entries:
+            if entry["state"] == "running":
+                entry["state"] = "pending"
+
+        # Start once the event loop runs so signals can be connected first
+        QtCore.QTimer.singleShot(0, self._schedule)
+
+    def _save(self):
+        os.makedirs(path.dirname(self.state_file), exist_ok=True)
+
+        # Write to a temporary file first so a crash can't leave a truncated queue
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(temp_file, self.state_file)
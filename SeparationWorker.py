@@ -0,0 +1,100 @@
+import shutil
+
+from PyQt6 import QtCore
+
+import Separation
+
+
+class SeparationJob(QtCore.QObject):
+    """
+    Runs demucs for a single file in a separate process so the
+    GUI stays responsive. Reports progress and can be cancelled.
+    """
+
+    progressChanged = QtCore.pyqtSignal(int)
+    finished = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, file_name, key, profile=None, out_dir=Separation.DEFAULT_OUTPUT_DIR, threads=None, jobs=1, stem_format=Separation.DEFAULT_STEM_FORMAT, *args, **kwargs):
+        """
+        profile: SeparationProfile to separate with, the default profile if None
+        threads: CPU threads of each segment job
+        jobs: Segments of the song separated in parallel
+        stem_format: File format of the stems, one of Separation.STEM_FORMATS
+        """
+        super().__init__(*args, **kwargs)
+
+        self.file_name = file_name
+        self.key = key
+        self.profile = profile if profile is not None else Separation.PROFILES[Separation.DEFAULT_PROFILE]
+        self.model = self.profile.model
+        self.out_dir = out_dir
+        self.threads = threads
+        self.jobs = jobs
+        self.stem_format = stem_format
+        self.separated_dir = Separation.separated_dir(key, self.model, out_dir)
+        self.progress = 0
+
+        self._cancelled = False
+        self._parser = Separation.ProgressParser(self.model, self.profile.shifts)
+
+        self._process = QtCore.QProcess(self)
+        self._process.setProcessChannelMode(QtCore.QProcess.ProcessChannelMode.MergedChannels)
+        self._process.readyReadStandardOutput.connect(self._read_output)
+        self._process.finished.connect(self._process_finished)
+        self._process.errorOccurred.connect(self._process_error)
+
+    def start(self):
+        command = Separation.demucs_command(self.file_name, self.key, self.model, self.out_dir, self.profile.options(), self.jobs, self.stem_format)
+
+        # Keep concurrent jobs from fighting over the same cores
+        if self.threads is not None:
+            environment = QtCore.QProcessEnvironment.systemEnvironment()
+            environment.insert("OMP_NUM_THREADS", str(self.threads))
+            environment.insert("MKL_NUM_THREADS", str(self.threads))
+            self._process.setProcessEnvironment(environment)
+
+        self._process.start(command[0], command[1:])
+
+    def cancel(self):
+        if not self.isRunning():
+            return
+
+        self._cancelled = True
+        self._process.kill()
+
+    def isCancelled(self):
+        return self._cancelled
+
+    def isRunning(self):
+        return self._process.state() != QtCore.QProcess.ProcessState.NotRunning
+
+    def _read_output(self):
+        text = bytes(self._process.readAllStandardOutput()).decode(errors="replace")
+        progress = self._parser.feed(text)
+
+        if progress is not None and progress != self.progress:
+            self.progress = progress
+            self.progressChanged.emit(progress)
+
+    def _process_finished(self, exit_code, exit_status):
+        if self._cancelled:
+            # Stems of a cancelled run are incomplete, nothing can use them
+            shutil.rmtree(self.separated_dir, ignore_errors=True)
+            self.failed.emit("Separation cancelled")
+            return
+
+        if exit_status != QtCore.QProcess.ExitStatus.NormalExit or exit_code != 0:
+            self.failed.emit(f"demucs exited with code {exit_code}")
+            return
+
+        if not Separation.is_separated(self.separated_dir):
+            self.failed.emit(f"demucs did not produce all stems in {self.separated_dir}")
+            return
+
+        self.progressChanged.emit(100)
+        self.finished.emit(self.separated_dir)
+
+    def _process_error(self, error):
+        if error == QtCore.QProcess.ProcessError.FailedToStart:
+            self.failed.emit("Could not start demucs")
@@ -0,0 +1,191 @@
+import os
+import struct
+import threading
+
+import Separation
+from MarkerStore import Marker
+
+
+SESSION_EXTENSION = ".session"
+SESSION_MAGIC = b"SPTS"
+SESSION_VERSION = 1
+# magic, version, number of mixers, number of markers
+SESSION_HEADER = struct.Struct("<4sHHI")
+# loop set, loop start, loop end, speed slider, transpose, start delay, loop delay,
+# delay type, bpm, bpm offset, snap mode, metronome on
+SESSION_SETTINGS = struct.Struct("<?qqhhhhBhiB?")
+# volume, muted, soloed
+SESSION_MIXER = struct.Struct("<B??")
+# position, slot, kind, color, name length
+SESSION_MARKER = struct.Struct("<qbB3sH")
+
+MARKER_KINDS = ("checkpoint", "marker", "bar")
+# Longest marker name in bytes, its length is stored in 16 bits
+MAX_NAME_LENGTH = 0xffff
+
+
+class Session:
+    """
+    Everything about practicing a song that should come back when it's
+    opened again: markers, loop, mixer, speed, delays and tempo. Stored
+    as a small binary file that reads back in a single pass.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.speed = 50
+        self.transpose = 0
+        self.start_delay = 0
+        self.loop_delay = 0
+        self.delay_type = 0
+        # 0 when the tempo was never set, so detection can fill it in
+        self.bpm = 0
+        self.bpm_offset = 0
+        self.snap = 0
+        self.metronome = False
+        # (volume, muted, soloed) per mixer strip
+        self.mixers = []
+        self.markers = []
+
+    def pack(self):
+        loop_start, loop_end = self.loop if self.loop is not None else (0, 0)
+
+        parts = [
+            SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, len(self.mixers), len(self.markers)),
+            SESSION_SETTINGS.pack(
+                self.loop is not None, loop_start, loop_end, self.speed, self.transpose,
+                self.start_delay, self.loop_delay, self.delay_type, self.bpm, self.bpm_offset,
+                self.snap, self.metronome,
+            ),
+        ]
+
+        for volume, muted, soloed in self.mixers:
+            parts.append(SESSION_MIXER.pack(volume, muted, soloed))
+
+        for marker in self.markers:
+            # Longer names are cut at a whole character
+            name = marker.name.encode("utf-8")[:MAX_NAME_LENGTH].decode("utf-8", errors="ignore").encode("utf-8")
+            slot = marker.slot if marker.slot is not None else -1
+            color = bytes.fromhex(marker.color.lstrip("#")[:6])
+            parts.append(SESSION_MARKER.pack(marker.position, slot, MARKER_KINDS.index(marker.kind), color, len(name)))
+            parts.append(name)
+
+        return b"".join(parts)
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Raises ValueError if data isn't a session of this version
+        """
+        try:
+            magic, version, n_mixers, n_markers = SESSION_HEADER.unpack_from(data, 0)
+            if magic != SESSION_MAGIC or version != SESSION_VERSION:
+                raise ValueError("Not a session file of this version")
+
+            session = cls()
+            offset = SESSION_HEADER.size
+
+            (
+                has_loop, loop_start, loop_end, session.speed, session.transpose,
+                session.start_delay, session.loop_delay, session.delay_type, session.bpm, session.bpm_offset,
+                session.snap, session.metronome,
+            ) = SESSION_SETTINGS.unpack_from(data, offset)
+            session.loop = (loop_start, loop_end) if has_loop else None
+            offset += SESSION_SETTINGS.size
+
+            for _ in range(n_mixers):
+                session.mixers.append(SESSION_MIXER.unpack_from(data, offset))
+                offset += SESSION_MIXER.size
+
+            for _ in range(n_markers):
+                position, slot, kind, color, name_length = SESSION_MARKER.unpack_from(data, offset)
+                offset += SESSION_MARKER.size
+                name = data[offset:offset + name_length].decode("utf-8")
+                offset += name_length
+
+                session.markers.append(Marker(position, name, f"#{color.hex()}", MARKER_KINDS[kind], slot if slot >= 0 else None))
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"Corrupt session file. {e}")
+
+        return session
+
+
+def session_path(key, out_dir=Separation.DEFAULT_OUTPUT_DIR):
+    return f"{out_dir}/sessions/{key}{SESSION_EXTENSION}"
+
+
+def load_session(key, out_dir=Separation.DEFAULT_OUTPUT_DIR):
+    """
+    Session of a song by its cache key, None if it has none
+    """
+    file_name = session_path(key, out_dir)
+
+    try:
+        with open(file_name, "rb") as f:
+            return Session.unpack(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read session {file_name}. {e}")
+        return None
+
+
+def save_session(key, session, out_dir=Separation.DEFAULT_OUTPUT_DIR):
+    file_name = session_path(key, out_dir)
+
+    try:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+        data = session.pack()
+
+        temp_file = f"{file_name}.{threading.get_ident()}.tmp"
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, file_name)
+    except (OSError, struct.error, ValueError) as e:
+        print(f"Warning: Could not write session {file_name}. {e}")
+
+
+class SessionWriter:
+    """
+    Writes sessions on a background thread. Only the latest session of
+    each song is kept while the thread is busy, older ones are skipped.
+    """
+
+    def __init__(self, out_dir=Separation.DEFAULT_OUTPUT_DIR):
+        self.out_dir = out_dir
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._writing = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, key, session):
+        with self._condition:
+            self._pending[key] = session
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Wait until every session handed over has been written
+        """
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                key, session = self._pending.popitem()
+                self._writing = True
+
+            # flush() must never wait on a write that went wrong
+            try:
+                save_session(key, session, self.out_dir)
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
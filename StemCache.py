@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from os import path
+
+import Separation
+
+
+DEFAULT_BUDGET = 20 * 1024**3
+HASH_CHUNK_SIZE = 1024**2
+# Seconds after which a lock on the index is taken to be left by a crash
+STALE_LOCK_AGE = 10
+
+
+def audio_hash(file_name):
+    sha = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def directory_size(directory):
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            size += path.getsize(path.join(root, name))
+    return size
+
+
+class _IndexLock:
+    """
+    Lock file held while the index is merged and written, so the GUI and
+    cli.py can share one cache. Works the same on every platform.
+    """
+
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self._fd = None
+
+    def __enter__(self):
+        while True:
+            try:
+                self._fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                pass
+
+            try:
+                if time.time() - path.getmtime(self.lock_file) > STALE_LOCK_AGE:
+                    os.remove(self.lock_file)
+            except OSError:
+                pass
+            time.sleep(0.01)
+
+    def __exit__(self, *args):
+        os.close(self._fd)
+        os.remove(self.lock_file)
+
+
+class StemCache:
+    """
+    Index of separated stems keyed by the content of the source audio
+    and the demucs settings used, so moved or renamed songs are still
+    found. Least recently used entries are removed once the cache
+    grows past its disk budget.
+    """
+
+    def __init__(self, out_dir=Separation.DEFAULT_OUTPUT_DIR, budget=DEFAULT_BUDGET):
+        self.out_dir = out_dir
+        self.budget = budget
+        self.index_file = f"{out_dir}/cache.json"
+
+        # entries: key -> {model, dir, size, last_access}
+        # files: absolute path -> {size, mtime, hash}, avoids rehashing unchanged files
+        self.entries = {}
+        self.files = {}
+
+        # Keys changed or removed since the index was last written, other
+        # processes' changes to the rest are kept when it's written again
+        self._changed = set()
+        self._removed = set()
+
+        # Keys that are in use and must never be evicted
+        self.pinned = set()
+
+        self._load()
+
+    def key(self, file_name, model=Separation.DEFAULT_MODEL, options=()):
+        content_hash = self._file_hash(file_name)
+        settings = json.dumps([model, list(options)])
+        return hashlib.sha256(f"{content_hash}:{settings}".encode()).hexdigest()[:32]
+
+    def directory(self, key, model=Separation.DEFAULT_MODEL):
+        return Separation.separated_dir(key, model, self.out_dir)
+
+    def lookup(self, file_name, model=Separation.DEFAULT_MODEL, options=()):
+        """
+        Returns the cache key and stem directory for a file, and whether
+        the stems are already there
+        """
+        key = self.key(file_name, model, options)
+        directory = self.directory(key, model)
+
+        if key in self.entries and Separation.is_separated(directory):
+            self.entries[key]["last_access"] = time.time()
+            self._changed.add(key)
+            self._save()
+            return key, directory, True
+
+        # Stems separated by another process that isn't written to the index yet
+        if Separation.is_separated(directory):
+            self.add(key, model)
+            return key, directory, True
+
+        # Stems were removed from disk behind our back
+        if key in self.entries:
+            del self.entries[key]
+            self._removed.add(key)
+            self._save()
+
+        return key, directory, False
+
+    def add(self, key, model=Separation.DEFAULT_MODEL):
+        directory = self.directory(key, model)
+        self.entries[key] = {
+            "model": model,
+            "dir": directory,
+            "size": directory_size(directory),
+            "last_access": time.time(),
+        }
+        self._changed.add(key)
+        self.evict(keep=key)
+
+    def measure(self, key):
+        """
+        Size an entry again, once waveform peaks or beats are saved next to its stems
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+
+        entry["size"] = directory_size(entry["dir"])
+        self._changed.add(key)
+        self.evict(keep=key)
+
+    def size(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits its budget
+        keep: Key of an entry that must not be removed, e.g. the song in use
+        """
+        total = self.size()
+
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_access"]):
+            if total <= self.budget:
+                break
+            if key == keep or key in self.pinned:
+                continue
+
+            entry = self.entries.pop(key)
+            self._removed.add(key)
+            shutil.rmtree(entry["dir"], ignore_errors=True)
+            total -= entry["size"]
+
+        self._save()
+
+    def _file_hash(self, file_name):
+        file_name = path.abspath(file_name)
+        stat = os.stat(file_name)
+
+        known = self.files.get(file_name)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+            return known["hash"]
+
+        content_hash = audio_hash(file_name)
+        self.files[file_name] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": content_hash}
+        self._save()
+        return content_hash
+
+    def _load(self):
+        if not path.isfile(self.index_file):
+            return
+
+        try:
+            self.entries, self.files = self._read_index()
+        except (OSError, ValueError, KeyError):
+            print(f"Error: Could not read stem cache index {self.index_file}")
+
+    def _read_index(self):
+        with open(self.index_file) as f:
+            index = json.load(f)
+        return index["entries"], index["files"]
+
+    def _save(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        with _IndexLock(self.index_file + ".lock"):
+            # Entries written by another process since are merged in
+            try:
+                entries, files = self._read_index()
+            except (OSError, ValueError, KeyError):
+                entries, files = {}, {}
+
+            for key in self._removed:
+                entries.pop(key, None)
+            for key in self._changed:
+                if key in self.entries:
+                    entries[key] = self.entries[key]
+            files.update(self.files)
+
+            self.entries = entries
+            self.files = files
+            self._changed.clear()
+            self._removed.clear()
+
+            temp_file = self.index_file + ".tmp"
+            with open(temp_file, "w") as f:
+                json.dump({"entries": self.entries, "files": self.files}, f)
+            os.replace(temp_file, self.index_file)
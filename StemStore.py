@@ -0,0 +1,321 @@
+import struct
+import threading
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+
+
+class Stem:
+    """
+    A WAV file mapped into memory as a (frames, channels) array. Nothing
+    is read until it's accessed and the pages are shared with the OS
+    page cache, so any number of readers cost no extra copies.
+    """
+
+    # The whole file can be indexed at once through data
+    mapped = True
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        with open(file_name, "rb") as f:
+            header = f.read(12)
+            if len(header) < 12 or header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+                raise ValueError(f"Not a WAV file: {file_name}")
+
+            fmt = None
+            while True:
+                chunk_header = f.read(8)
+                if len(chunk_header) < 8:
+                    raise ValueError(f"No audio data in {file_name}")
+
+                chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    f.seek(chunk_size % 2, 1)
+                elif chunk_id == b"data":
+                    data_offset = f.tell()
+                    break
+                else:
+                    f.seek(chunk_size + chunk_size % 2, 1)
+
+            f.seek(0, 2)
+            file_size = f.tell()
+
+        if fmt is None:
+            raise ValueError(f"Missing format chunk in {file_name}")
+
+        audio_format, self.n_channels, self.sample_rate = struct.unpack("<HHI", fmt[0:8])
+        bits = struct.unpack("<H", fmt[14:16])[0]
+
+        # WAVE_FORMAT_EXTENSIBLE keeps the real format at the start of the subformat GUID
+        if audio_format == 0xFFFE:
+            audio_format = struct.unpack("<H", fmt[24:26])[0]
+
+        if audio_format == 1 and bits == 16:
+            self.dtype = np.int16
+            self.scale = 1 / 32768
+        elif audio_format == 3 and bits == 32:
+            self.dtype = np.float32
+            self.scale = 1
+        else:
+            raise ValueError(f"Unsupported WAV format {audio_format} with {bits} bits: {file_name}")
+
+        # Writers that stream their output sometimes leave a bogus data size
+        frame_size = self.n_channels * bits // 8
+        self.n_frames = (min(chunk_size, file_size - data_offset)) // frame_size
+
+        self.data = np.memmap(file_name, dtype=self.dtype, mode="r", offset=data_offset, shape=(self.n_frames, self.n_channels))
+
+    def read(self, start, stop):
+        """
+        Frames from start to stop as a (frames, channels) array
+        """
+        return self.data[max(start, 0):max(stop, start, 0)]
+
+    def channel(self, index):
+        """
+        View of a single channel, mono files return their only channel
+        """
+        return self.data[:, min(index, self.n_channels - 1)]
+
+
+class CompressedStem:
+    """
+    A FLAC or other compressed stem, decoded a block at a time as it's
+    read. The blocks read last are kept, so playback decodes every block
+    once. Long reads, like analysis, decode with a file handle of their own
+    and don't push playback out of the kept blocks.
+    """
+
+    mapped = False
+
+    # Frames decoded at a time and how many blocks are kept
+    block_size = 65536
+    kept_blocks = 8
+
+    def __init__(self, file_name):
+        try:
+            import soundfile
+        except ImportError:
+            raise ValueError(f"soundfile is needed to read {file_name}")
+
+        self.file_name = file_name
+        self._soundfile = soundfile
+
+        try:
+            self._file = soundfile.SoundFile(file_name)
+        except RuntimeError as e:
+            raise ValueError(f"Could not decode {file_name}. {e}")
+
+        self.n_channels = self._file.channels
+        self.sample_rate = self._file.samplerate
+        self.n_frames = self._file.frames
+
+        if self._file.subtype == "PCM_16":
+            self.dtype = np.int16
+            self.scale = 1 / 32768
+        else:
+            self.dtype = np.float32
+            self.scale = 1
+
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, start, stop):
+        """
+        Frames from start to stop as a (frames, channels) array
+        """
+        start = max(start, 0)
+        stop = min(stop, self.n_frames)
+        if stop <= start:
+            return np.zeros((0, self.n_channels), dtype=self.dtype)
+
+        first = start // self.block_size
+        last = (stop - 1) // self.block_size
+
+        if last - first >= self.kept_blocks:
+            frames = self._decode(start, stop)
+        else:
+            # Playback, the loop renderer and the waveform read from different threads
+            with self._lock:
+                blocks = [self._block(index) for index in range(first, last + 1)]
+
+            offset = first * self.block_size
+            frames = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+            frames = frames[start - offset:stop - offset]
+
+        # Compressed files can hold a few frames less than they claim
+        if len(frames) < stop - start:
+            frames = np.concatenate((frames, np.zeros((stop - start - len(frames), self.n_channels), dtype=self.dtype)))
+
+        return frames
+
+    def _block(self, index):
+        block = self._blocks.get(index)
+
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+
+        self._file.seek(index * self.block_size)
+        block = self._file.read(self.block_size, dtype=np.dtype(self.dtype).name, always_2d=True)
+
+        self._blocks[index] = block
+        if len(self._blocks) > self.kept_blocks:
+            self._blocks.popitem(last=False)
+
+        return block
+
+    def _decode(self, start, stop):
+        with self._soundfile.SoundFile(self.file_name) as f:
+            f.seek(start)
+            return f.read(stop - start, dtype=np.dtype(self.dtype).name, always_2d=True)
+
+
+def open_stem(file_name):
+    """
+    WAV stems are mapped into memory, anything else is decoded as it's read
+    """
+    if path.splitext(file_name)[1].lower() == ".wav":
+        return Stem(file_name)
+    return CompressedStem(file_name)
+
+
+class StemStore:
+    """
+    The stems of one song, opened once and shared by everything that
+    needs the audio: playback, waveform display and analysis. Stems are
+    only ever read a range of frames at a time, so compressed ones never
+    have to be decoded whole.
+    """
+
+    def __init__(self, file_names):
+        self.file_names = list(file_names)
+        self.stems = [open_stem(file_name) for file_name in self.file_names]
+
+        self.sample_rate = self.stems[0].sample_rate
+        for stem in self.stems:
+            if stem.sample_rate != self.sample_rate:
+                raise ValueError(f"Stems have different sample rates: {stem.file_name}")
+
+        # Stems of one song can differ by a few frames
+        self.n_frames = min(stem.n_frames for stem in self.stems)
+        self.n_channels = 2
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __getitem__(self, index):
+        return self.stems[index]
+
+    def duration(self):
+        return self.n_frames / self.sample_rate
+
+    def mix(self, gains, start, stop):
+        """
+        Sum the stems between two frames with their gains, as float32 in [-1, 1]
+        """
+        stop = min(stop, self.n_frames)
+        out = np.zeros((max(stop - start, 0), self.n_channels), dtype=np.float32)
+
+        for gain, stem in zip(gains, self.stems):
+            # Muted stems aren't even read
+            if gain == 0:
+                continue
+            out += np.float32(gain * stem.scale) * stem.read(start, stop)[:, :self.n_channels]
+
+        return out
+
+
+class _MixStem:
+    """
+    One of the stems of a MixStore, each of them is the whole mix
+    """
+
+    # Nothing is cached for a stem without a file of its own, like waveform peaks
+    file_name = None
+    mapped = True
+    dtype = np.int16
+    n_channels = 2
+
+    def __init__(self, store, n_stems):
+        self.store = store
+        self.sample_rate = store.sample_rate
+        self.scale = 1 / 32768 / n_stems
+
+    @property
+    def data(self):
+        return self.store.buffer[:self.store.n_frames]
+
+    @property
+    def n_frames(self):
+        return self.store.n_frames
+
+    def read(self, start, stop):
+        return self.data[max(start, 0):max(stop, start, 0)]
+
+    def channel(self, index):
+        return self.data[:, index]
+
+
+class MixStore:
+    """
+    The original mix of a song, standing in for its stems until they're
+    separated. Each stem is the whole mix at an equal share of its level,
+    so the stems add up to the mix and the track gains still turn it down.
+    Audio is appended while it's being decoded, what isn't there yet is silent.
+    """
+
+    def __init__(self, file_name, n_stems, sample_rate, n_frames=0):
+        self.file_name = file_name
+        self.file_names = [file_name]
+        self.sample_rate = sample_rate
+        self.n_channels = 2
+
+        self.buffer = np.zeros((max(n_frames, sample_rate), self.n_channels), dtype=np.int16)
+        self.n_frames = n_frames
+        self.decoded = 0
+        # Length the file claimed, 0 if it didn't know
+        self.claimed = n_frames
+
+        self.stems = [_MixStem(self, n_stems) for _ in range(n_stems)]
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __getitem__(self, index):
+        return self.stems[index]
+
+    def duration(self):
+        return self.n_frames / self.sample_rate
+
+    def append(self, frames):
+        """
+        Add decoded int16 frames after the ones before, from the decoding thread
+        """
+        end = self.decoded + len(frames)
+
+        # Readers keep using the old buffer until the new one is swapped in.
+        # Past a claimed length only a little is missing, otherwise the length is unknown.
+        if end > len(self.buffer):
+            grow = len(frames) if self.claimed > 0 else len(self.buffer)
+            buffer = np.zeros((max(end, len(self.buffer) + grow), self.n_channels), dtype=np.int16)
+            buffer[:self.decoded] = self.buffer[:self.decoded]
+            self.buffer = buffer
+
+        self.buffer[self.decoded:end] = frames
+        self.decoded = end
+        self.n_frames = max(self.n_frames, end)
+
+    def finish(self):
+        """
+        The decoded length replaces the one the file claimed
+        """
+        self.n_frames = self.decoded
+
+    def mix(self, gains, start, stop):
+        stop = min(stop, self.n_frames)
+        gain = np.float32(sum(gains) / len(self.stems) / 32768)
+        return gain * self.buffer[start:max(stop, start)].astype(np.float32)
@@ -0,0 +1,225 @@
+import math
+import time
+
+import numpy as np
+
+
+class TimeStretcher:
+    """
+    Streaming WSOLA time-stretch. Changes the tempo of the audio pulled
+    from read without changing its pitch, by overlap-adding windowed
+    grains whose position is nudged to line up with the waveform of the
+    previous grain. A pitch shift is a stretch to a different tempo,
+    resampled back to the requested one.
+    read: Function returning up to n frames as a (frames, channels) float32
+          array, fewer only at the end of the stream
+    budget: Share of real time processing may take. When a block goes over
+            it, the search for aligned grains is narrowed until it fits.
+    """
+
+    min_tolerance = 32
+    # Taps of the low-pass ahead of a pitch shift up, odd so it's a plain delay otherwise
+    filter_taps = 63
+
+    def __init__(self, read, n_channels=2, window_size=1024, tolerance=256, sample_rate=44100, budget=None):
+        self.read = read
+        self.n_channels = n_channels
+        self.window_size = window_size
+        self.hop = window_size // 2
+        self.max_tolerance = tolerance
+        self.sample_rate = sample_rate
+        self.budget = budget
+        self.rate = 1.0
+        self.pitch = 1.0
+
+        # Periodic Hann windows at half overlap add up to exactly one
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(window_size) / window_size)).astype(np.float32)[:, None]
+
+        self._set_tolerance(tolerance)
+        self.reset()
+
+    def _set_tolerance(self, tolerance):
+        self.tolerance = tolerance
+        self._fft_size = 1 << int(np.ceil(np.log2(self.window_size * 2 + tolerance * 2)))
+
+    def reset(self):
+        """
+        Forget all buffered audio, the next frame read starts stream position 0
+        """
+        self._buffer = np.zeros((0, self.n_channels), dtype=np.float32)
+        self._buffer_start = 0
+        self._ended = False
+
+        self._analysis = 0.0
+        self._previous = None
+        self._output = np.zeros((self.window_size, self.n_channels), dtype=np.float32)
+        self._ready = np.zeros((0, self.n_channels), dtype=np.float32)
+
+        # Stretched frames waiting to be resampled for a pitch shift
+        self._pending = np.zeros((0, self.n_channels), dtype=np.float32)
+        self._phase = 0.0
+        self._filter_tail = np.zeros((self.filter_taps - 1, self.n_channels), dtype=np.float32)
+        self._kernel = None
+        self._kernel_pitch = None
+
+    def position(self):
+        """
+        Stream position of the audio that is coming out right now
+        """
+        if self._previous is None:
+            return int(self._analysis)
+        return self._previous
+
+    def _fill(self, stop):
+        """
+        Make sure the buffer reaches the absolute stream position stop
+        """
+        missing = stop - (self._buffer_start + len(self._buffer))
+        if missing <= 0 or self._ended:
+            return
+
+        frames = self.read(missing)
+        if len(frames) < missing:
+            self._ended = True
+        self._buffer = np.concatenate((self._buffer, frames))
+
+    def _slice(self, start, stop):
+        """
+        Frames between two absolute stream positions, zero padded past the end
+        """
+        self._fill(stop)
+        frames = self._buffer[start - self._buffer_start:stop - self._buffer_start]
+        if len(frames) < stop - start:
+            frames = np.concatenate((frames, np.zeros((stop - start - len(frames), self.n_channels), dtype=np.float32)))
+        return frames
+
+    def _best_position(self, target):
+        """
+        Grain start within the tolerance of target that best continues the previous grain
+        """
+        natural = self._previous + self.hop
+        first = max(target - self.tolerance, self._buffer_start)
+        last = target + self.tolerance
+
+        template = self._slice(natural, natural + self.window_size).sum(axis=1)
+        region = self._slice(first, last + self.window_size).sum(axis=1)
+
+        spectrum = np.fft.rfft(region, self._fft_size) * np.conj(np.fft.rfft(template, self._fft_size))
+        correlation = np.fft.irfft(spectrum, self._fft_size)[:last - first + 1]
+
+        # Normalise by the energy under each candidate so loud passages don't always win
+        energy = np.concatenate(([0], np.cumsum(region.astype(np.float64) ** 2)))
+        energy = energy[self.window_size:self.window_size + len(correlation)] - energy[:len(correlation)]
+        score = correlation / np.sqrt(np.maximum(energy, 1e-9))
+
+        return first + int(np.argmax(score))
+
+    def _next_grain(self):
+        target = int(round(self._analysis))
+
+        if self._previous is None:
+            position = target
+        else:
+            position = self._best_position(target)
+
+        grain = self._slice(position, position + self.window_size) * self.window
+
+        self._previous = position
+        self._analysis += self.hop * self.rate / self.pitch
+
+        # Nothing before the next search window will be needed again
+        keep_from = min(int(self._analysis) - self.tolerance, self._previous + self.hop)
+        drop = keep_from - self._buffer_start
+        if drop > 0:
+            self._buffer = self._buffer[drop:]
+            self._buffer_start += drop
+
+        return grain
+
+    def _finished(self):
+        return self._ended and int(self._analysis) >= self._buffer_start + len(self._buffer)
+
+    def _stretch(self, n_frames):
+        while len(self._ready) < n_frames and not self._finished():
+            self._output += self._next_grain()
+            self._ready = np.concatenate((self._ready, self._output[:self.hop]))
+            self._output = np.concatenate((self._output[self.hop:], np.zeros((self.hop, self.n_channels), dtype=np.float32)))
+
+        block = self._ready[:n_frames]
+        self._ready = self._ready[len(block):]
+        return block
+
+    def _lowpass(self, frames):
+        """
+        Windowed-sinc low-pass at the Nyquist frequency of the audio read
+        pitch times as fast, so shifting up doesn't alias. Delays the audio
+        by half the filter, also while shifting down where it doesn't filter.
+        """
+        # Nothing more comes at the end of the stream
+        if len(frames) == 0:
+            return frames
+
+        frames = np.concatenate((self._filter_tail, frames))
+        self._filter_tail = frames[len(frames) - len(self._filter_tail):]
+
+        if self.pitch <= 1:
+            return frames[:len(frames) - len(self._filter_tail)]
+
+        if self._kernel_pitch != self.pitch:
+            cutoff = 0.5 / self.pitch
+            n = np.arange(self.filter_taps) - (self.filter_taps - 1) / 2
+            kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(self.filter_taps)
+            self._kernel = (kernel / kernel.sum()).astype(np.float32)
+            self._kernel_pitch = self.pitch
+
+        windows = np.lib.stride_tricks.sliding_window_view(frames, self.filter_taps, axis=0)
+        return windows @ self._kernel[::-1]
+
+    def _resample(self, n_frames):
+        """
+        Linear interpolation of the stretched audio, reading it pitch times as fast
+        """
+        pitch = self.pitch
+        phase = self._phase
+        needed = int(phase + (n_frames - 1) * pitch) + 2
+
+        if len(self._pending) < needed:
+            self._pending = np.concatenate((self._pending, self._lowpass(self._stretch(needed - len(self._pending)))))
+
+        # Near the end of the stream only part of the block can be interpolated
+        if len(self._pending) < needed:
+            n_frames = max(math.floor((len(self._pending) - 2 - phase) / pitch) + 1, 0)
+
+        positions = phase + np.arange(n_frames) * pitch
+        indices = positions.astype(np.int64)
+        fractions = (positions - indices)[:, None].astype(np.float32)
+        block = self._pending[indices] * (1 - fractions) + self._pending[indices + 1] * fractions
+
+        consumed = int(phase + n_frames * pitch)
+        self._phase = phase + n_frames * pitch - consumed
+        self._pending = self._pending[consumed:]
+        return block
+
+    def _keep_budget(self, elapsed, n_frames):
+        load = elapsed * self.sample_rate / n_frames
+
+        if load > self.budget and self.tolerance > self.min_tolerance:
+            self._set_tolerance(self.tolerance // 2)
+        elif load < self.budget / 4 and self.tolerance < self.max_tolerance:
+            self._set_tolerance(self.tolerance * 2)
+
+    def process(self, n_frames):
+        """
+        Next n_frames of stretched audio, fewer once the stream has ended
+        """
+        start = time.perf_counter()
+
+        if self.pitch == 1 and len(self._pending) == 0:
+            block = self._stretch(n_frames)
+        else:
+            block = self._resample(n_frames)
+
+        if self.budget is not None and len(block) > 0:
+            self._keep_budget(time.perf_counter() - start, len(block))
+
+        return block
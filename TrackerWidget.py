@@ -1,22 +1,82 @@
 from PyQt6 import QtCore, QtGui, QtWidgets
 from PyQt6.QtCore import Qt
-import pyqtgraph as pg
-import wave
 import numpy as np
+import time
+
+import WaveformPeaks
 
 
 class _Tracker(QtWidgets.QWidget):
+    """
+    Overlay with the loop, markers and playhead. Everything except
+    the playhead is rendered together with the waveform into a cached
+    pixmap, so moving the playhead only repaints a thin strip.
+    """
+
+    triangle_size = 4
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def paintEvent(self, e):
-        painter = QtGui.QPainter(self)
+        # The cached pixmap covers the graph below, so Qt can skip repainting it
+        self.setAttribute(Qt.WidgetAttribute.WA_OpaquePaintEvent)
+
+        self._cache = None
+        self._rebuild_pending = False
+        self._playhead_x = 0
+
+        loop_color = QtGui.QColor.fromString("#f2cdcd")
+        loop_color.setAlpha(40)
+        self._loop_brush = QtGui.QBrush(loop_color, Qt.BrushStyle.SolidPattern)
+        self._playhead_brush = QtGui.QBrush(QtGui.QColor.fromString("#f38ba8"), Qt.BrushStyle.SolidPattern)
+        self._marker_colors = {}
+
+        size = self.triangle_size
+        self._triangle_top = QtGui.QPainterPath()
+        self._triangle_top.moveTo(-size, 0)
+        self._triangle_top.lineTo(size, 0)
+        self._triangle_top.lineTo(0, size)
+        self._triangle_top.closeSubpath()
+
+        self._triangle_bot = QtGui.QPainterPath()
+        self._triangle_bot.moveTo(-size, 0)
+        self._triangle_bot.lineTo(size, 0)
+        self._triangle_bot.lineTo(0, -size)
+        self._triangle_bot.closeSubpath()
+
+    def _to_x(self, value):
+        _start, _end = self.parent().viewRange()
+
+        if _end <= _start:
+            return 0
+
+        # Values outside of the view end up just past the edges
+        x = (value - _start) / (_end - _start) * self.width()
+        return int(min(max(x, -self.triangle_size * 2), self.width() + self.triangle_size * 2))
+
+    def invalidate(self):
+        """
+        Rebuild the cached layer once control returns to the event loop
+        """
+        if self._rebuild_pending:
+            return
+
+        self._rebuild_pending = True
+        QtCore.QTimer.singleShot(0, self._rebuild_cache)
+
+    def _rebuild_cache(self):
+        self._rebuild_pending = False
 
-        _pos = self.parent().position()
-        _min = self.parent().minimum()
-        _max = self.parent().maximum()
-        _width = painter.device().width()
-        _height = painter.device().height()
+        graph = self.parent().graph
+        if graph is not None:
+            self._cache = graph.grab()
+        else:
+            self._cache = QtGui.QPixmap(self.size())
+            self._cache.fill(self.parent().bg_color)
+
+        painter = QtGui.QPainter(self._cache)
+        _width = self.width()
+        _height = self.height()
 
         bar_width = 2
 
@@ -24,95 +84,234 @@ class _Tracker(QtWidgets.QWidget):
         loop = self.parent().loop
 
         if loop is not None:
-            brush = QtGui.QBrush()
-            color = QtGui.QColor.fromString("#f2cdcd")
-            color.setAlpha(40)
-            brush.setColor(color)
-            brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-            loop_visual_start = int(np.interp(loop[0], [_min, _max], [0, _width]))
-            loop_visual_end = int(np.interp(loop[1], [_min, _max], [0, _width]))
-
-            rect = QtCore.QRect(QtCore.QPoint(loop_visual_start, 0), QtCore.QPoint(loop_visual_end, _height))
-            painter.fillRect(rect, brush)
-
-        # Paint checkpoints
-        checkpoints = self.parent().checkpoints
-        for checkpoint in checkpoints.values():
-            brush = QtGui.QBrush()
-            color = checkpoint[1]
+            rect = QtCore.QRect(QtCore.QPoint(self._to_x(loop[0]), 0), QtCore.QPoint(self._to_x(loop[1]), _height))
+            painter.fillRect(rect, self._loop_brush)
+
+        self._paint_markers(painter, bar_width)
+
+        painter.end()
+        self.update()
+
+    def _marker_color(self, name):
+        color = self._marker_colors.get(name)
+        if color is None:
+            color = QtGui.QColor.fromString(name)
             color.setAlpha(150)
-            brush.setColor(checkpoint[1])
-            brush.setStyle(Qt.BrushStyle.SolidPattern)
-
-            visual_position = int(np.interp(checkpoint[0], [_min, _max], [0, _width]))
-            if visual_position == _width:
-                visual_position -= 2
-            if visual_position == _width - 1:
-                visual_position -= 1
-            
-            rect = QtCore.QRect(visual_position, 0, bar_width, painter.device().height())
-            painter.fillRect(rect, brush)
+            self._marker_colors[name] = color
+        return color
 
-        # Paint current position
-        brush = QtGui.QBrush()
-        brush.setColor(QtGui.QColor.fromString("#f38ba8"))
-        brush.setStyle(Qt.BrushStyle.SolidPattern)
+    def _paint_markers(self, painter, bar_width):
+        markers = self.parent().markers
+        if markers is None or len(markers) == 0:
+            return
 
-        bar_width = 1
-        triangle_size = 4
+        _width = self.width()
+        _height = self.height()
+        _start, _end = self.parent().viewRange()
+        if _end <= _start:
+            return
+
+        first, last = markers.span(_start, _end)
+        if first >= last:
+            return
+
+        visible = markers.markers[first:last]
+        xs = (np.array(markers.positions[first:last]) - _start) / (_end - _start) * _width
+        xs = np.minimum(xs.astype(np.int64), _width - bar_width).tolist()
 
-        visual_position = int(np.interp(_pos, [_min, _max], [0, _width]))
+        # One rectangle per pixel column and color, drawn in one call per color
+        columns = {}
+        for marker, x in zip(visible, xs):
+            columns.setdefault(marker.color, set()).add(x)
 
-        if visual_position == _width - 1:
-            visual_position -= 1
+        painter.setPen(Qt.PenStyle.NoPen)
+        for color, columns_x in columns.items():
+            painter.setBrush(self._marker_color(color))
+            painter.drawRects([QtCore.QRect(x, 0, bar_width, _height) for x in columns_x])
 
-        rect = QtCore.QRect(visual_position, 0, bar_width, painter.device().height())
+        # Names are left out where they would overlap the one before
+        painter.setPen(self.parent().fg_color)
+        metrics = painter.fontMetrics()
+        label_end = -1
+        for marker, x in zip(visible, xs):
+            if not marker.name or x + 3 <= label_end:
+                continue
 
-        triangle_top = QtGui.QPainterPath()
-        triangle_top.moveTo(visual_position - triangle_size, 0)
-        triangle_top.lineTo(visual_position + triangle_size, 0)
-        triangle_top.lineTo(visual_position, triangle_size)
-        triangle_top.lineTo(visual_position - triangle_size, 0)
+            painter.drawText(x + 3, metrics.ascent(), marker.name)
+            label_end = x + 3 + metrics.horizontalAdvance(marker.name) + 4
+
+    def _playhead_rect(self, x):
+        size = self.triangle_size
+        return QtCore.QRect(x - size - 1, 0, size * 2 + 3, self.height())
+
+    def movePlayhead(self):
+        x = min(self._to_x(self.parent().position()), self.width() - 2)
+
+        if x == self._playhead_x:
+            return
 
-        triangle_bot = QtGui.QPainterPath()
-        triangle_bot.moveTo(visual_position - triangle_size, _height)
-        triangle_bot.lineTo(visual_position + triangle_size, _height)
-        triangle_bot.lineTo(visual_position, _height - triangle_size)
-        triangle_bot.lineTo(visual_position - triangle_size, _height)
+        self.update(self._playhead_rect(self._playhead_x))
+        self.update(self._playhead_rect(x))
+        self._playhead_x = x
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
+
+        if self.parent() is None:
+            return
+
+        self._playhead_x = min(self._to_x(self.parent().position()), self.width() - 2)
+        self.invalidate()
+
+    def paintEvent(self, e):
+        painter = QtGui.QPainter(self)
 
-        painter.fillPath(triangle_top, brush)
-        painter.fillPath(triangle_bot, brush)
-        painter.fillRect(rect, brush)
+        # Only the exposed region is copied from the cache
+        if self._cache is not None:
+            painter.drawPixmap(0, 0, self._cache)
+        else:
+            painter.fillRect(e.rect(), self.parent().bg_color)
+
+        # Paint current position
+        x = self._playhead_x
+        _height = self.height()
+
+        painter.fillRect(QtCore.QRect(x, 0, 1, _height), self._playhead_brush)
+        painter.translate(x, 0)
+        painter.fillPath(self._triangle_top, self._playhead_brush)
+        painter.translate(0, _height)
+        painter.fillPath(self._triangle_bot, self._playhead_brush)
 
         painter.end()
 
+        # The window is on screen, the graph can be made now
+        self.parent()._request_graph()
+
+
+class _PeakWorker(QtCore.QThread):
+    """
+    Computes the peak pyramids of a song off the GUI thread. Every stem
+    first gets a coarse estimate, then is refined chunk by chunk with
+    intermediate results emitted along the way.
+    """
+
+    # generation, stem index, pyramid, final
+    pyramidReady = QtCore.pyqtSignal(int, int, object, bool)
+    # generation, once the peaks it built are saved next to the stems
+    saved = QtCore.pyqtSignal(int)
+
+    update_interval = 0.2
+
+    def __init__(self, generation, stem_store, order, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.generation = generation
+        self.stem_store = stem_store
+        self.order = order
+
+    def run(self):
+        builders = []
+
+        for i in self.order:
+            stem = self.stem_store[i]
+
+            pyramid = WaveformPeaks.load_sidecar(stem)
+            if pyramid is not None:
+                self.pyramidReady.emit(self.generation, i, pyramid, True)
+                continue
+
+            builder = WaveformPeaks.PeakBuilder(stem)
+            builders.append((i, builder))
+            self.pyramidReady.emit(self.generation, i, builder.pyramid(), False)
+
+            if self.isInterruptionRequested():
+                return
+
+        for i, builder in builders:
+            last_update = time.monotonic()
+
+            while not builder.done():
+                if self.isInterruptionRequested():
+                    return
+
+                builder.step()
+
+                if time.monotonic() - last_update > self.update_interval:
+                    self.pyramidReady.emit(self.generation, i, builder.pyramid(), False)
+                    last_update = time.monotonic()
+
+            pyramid = builder.pyramid()
+            WaveformPeaks.save_sidecar(self.stem_store[i], pyramid)
+            self.pyramidReady.emit(self.generation, i, pyramid, True)
+
+        if len(builders) > 0:
+            self.saved.emit(self.generation)
+
 
 class TrackerWidget(QtWidgets.QWidget):
     # FIXME: Clean up private/public fields
     bg_color = QtGui.QColor.fromString("black")
     fg_color = QtGui.QColor.fromString("white")
-    players = None
+    stem_store = None
     track_to_graph = -1 # Graph sum if -1
     audio_file_path = None
-    n_visual_samples = 200_000
+    pyramids = []
+    track_gains = None
 
     _position = 0
     _minimum = 0
     _maximum = 100
 
-    checkpoints = {}
+    # Visible range in the same unit as the position, floats so it can go below a millisecond
+    _view_start = 0.0
+    _view_end = 100.0
+    min_view_frames = 32
+    zoom_step = 1.25
+
+    markers = None
     loop = None
 
     trackerMoved = QtCore.pyqtSignal(int)
+    # Waveform peaks of the stems were built and saved next to them
+    peaksSaved = QtCore.pyqtSignal()
 
-    def __init__(self, players, *args, **kwargs):
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.players = players
+        self._envelopes = None
+        self._final = []
+        self._generation = 0
+        self._workers = []
 
         self.tracker = _Tracker()
 
+        # Made after the window is first painted, see _create_graph
+        self.graph = None
+        self._graph_pending = False
+
+        self.pen = QtGui.QPen(self.fg_color, 1)
+        self.pen.setCosmetic(True)
+        self.pen_alt = QtGui.QPen(self.fg_color, 1)
+        self.pen_alt.setCosmetic(True)
+
+        self.times = np.linspace(0, 1, num=2)
+        self.amplitudes_l = np.zeros(2)
+        self.amplitudes_r = np.zeros(2) 
+
+        layout = QtWidgets.QStackedLayout()
+        layout.addWidget(self.tracker)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setStackingMode(QtWidgets.QStackedLayout.StackingMode.StackAll)
+
+        self.setLayout(layout)
+
+    def _create_graph(self):
+        """
+        Importing pyqtgraph takes about as long as building the rest of the
+        window, so the waveform graph is only made once the window is up
+        """
+        import pyqtgraph as pg
+
         self.graph = pg.PlotWidget()
 
         self.graph.setAntialiasing(True)
@@ -122,24 +321,22 @@ class TrackerWidget(QtWidgets.QWidget):
         self.graph.getPlotItem().hideAxis("left")
         self.graph.getPlotItem().setClipToView(True)
         self.graph.getPlotItem().getViewBox().setDefaultPadding(0)
-
-        self.pen = pg.mkPen(self.fg_color)
-        self.pen_alt = pg.mkPen(self.fg_color)
-
-        self.times = np.linspace(0, 1, num=2)
-        self.amplitudes_l = np.zeros(2)
-        self.amplitudes_r = np.zeros(2) 
+        self.graph.setBackground(self.bg_color)
 
         self.plot_l = self.graph.plot(self.times, self.amplitudes_l, pen=self.pen_alt, skipFiniteCheck=True)
         self.plot_r = self.graph.plot(self.times, self.amplitudes_l, pen=self.pen, skipFiniteCheck=True)
 
-        layout = QtWidgets.QStackedLayout()
-        layout.addWidget(self.graph)
-        layout.addWidget(self.tracker)
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setStackingMode(QtWidgets.QStackedLayout.StackingMode.StackAll)
+        # The overlay covers the graph with its cached copy of it
+        self.layout().insertWidget(0, self.graph)
+        self.tracker.raise_()
 
-        self.setLayout(layout)
+        self.update_audio_data()
+        self.tracker.invalidate()
+
+    def _request_graph(self):
+        if self.graph is None and not self._graph_pending:
+            self._graph_pending = True
+            QtCore.QTimer.singleShot(0, self._create_graph)
 
     def _calculate_clicked_value(self, e):
         click_x = int(e.position().x())
@@ -151,7 +348,8 @@ class TrackerWidget(QtWidgets.QWidget):
         if click_x < 0:
             click_x = 0
 
-        self.setTrackerPosition(int(np.interp(click_x, [0, width], [self._minimum, self._maximum])))
+        position = self._view_start + click_x / max(width, 1) * (self._view_end - self._view_start)
+        self.setTrackerPosition(int(min(max(position, self._minimum), self._maximum)))
         self.trackerMoved.emit(self._position)
 
     def mouseMoveEvent(self, e):
@@ -160,67 +358,223 @@ class TrackerWidget(QtWidgets.QWidget):
     def mousePressEvent(self, e):
         self._calculate_clicked_value(e)
 
+    def wheelEvent(self, e):
+        delta = e.angleDelta()
+
+        # Horizontal or shift scrolling pans, plain scrolling zooms around the cursor
+        if delta.x() != 0 or e.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+            steps = (delta.x() or delta.y()) / 120
+            span = self._view_end - self._view_start
+            self.setViewRange(self._view_start - steps * span / 10, self._view_end - steps * span / 10)
+        elif delta.y() != 0:
+            anchor = self._view_start + e.position().x() / max(self.width(), 1) * (self._view_end - self._view_start)
+            factor = self.zoom_step ** (-delta.y() / 120)
+            self.setViewRange(anchor - (anchor - self._view_start) * factor, anchor + (self._view_end - anchor) * factor)
+
+        e.accept()
+
+    def mouseDoubleClickEvent(self, e):
+        self.resetZoom()
+
+    def viewRange(self):
+        return self._view_start, self._view_end
+
+    def setViewRange(self, start, end):
+        full_span = self._maximum - self._minimum
+
+        min_span = full_span
+        if self.stem_store is not None and self.stem_store.n_frames > 0:
+            min_span = min(full_span, self.min_view_frames / self.stem_store.sample_rate * 1000)
+
+        span = min(max(end - start, min_span), full_span)
+        start = min(max(start, self._minimum), self._maximum - span)
+
+        if (start, start + span) == (self._view_start, self._view_end):
+            return
+
+        self._view_start = start
+        self._view_end = start + span
+        self.update_audio_data()
+        self.tracker.movePlayhead()
+
+    def resetZoom(self):
+        self.setViewRange(self._minimum, self._maximum)
+
+    def isZoomed(self):
+        return self._view_end - self._view_start < self._maximum - self._minimum
+
+    def _visible_frames(self):
+        to_frame = self.stem_store.sample_rate / 1000
+        start = int(self._view_start * to_frame)
+        stop = int(np.ceil(self._view_end * to_frame))
+        return max(start, 0), min(max(stop, start + 1), self.stem_store.n_frames)
+
+    def _stem_envelopes(self, width, start, stop):
+        """
+        Envelopes of all stems in a range of frames as (stems, width, channels)
+        arrays, kept until the view, the width or the source changes
+        """
+        if self._envelopes is not None and self._envelopes[0] == (width, start, stop):
+            return self._envelopes[1:]
+
+        n_stems = len(self.stem_store)
+        frames_per_pixel = (stop - start) / width
+
+        if frames_per_pixel < 1:
+            # Fewer frames than pixels, every frame is drawn on its own
+            mins = np.zeros((n_stems, stop - start, 2), dtype=np.float32)
+            for i, stem in enumerate(self.stem_store):
+                mins[i] = stem.read(start, stop)[:, :2] * np.float32(stem.scale)
+            maxs = mins
+        elif frames_per_pixel < WaveformPeaks.BASE_BLOCK_SIZE:
+            # Finer than the pyramid, the few visible frames are read directly
+            edges = np.linspace(0, stop - start, width, endpoint=False).astype(np.int64)
+            mins = np.zeros((n_stems, width, 2), dtype=np.float32)
+            maxs = np.zeros((n_stems, width, 2), dtype=np.float32)
+            for i, stem in enumerate(self.stem_store):
+                frames = stem.read(start, stop)[:, :2] * np.float32(stem.scale)
+                mins[i] = np.minimum.reduceat(frames, edges, axis=0)
+                maxs[i] = np.maximum.reduceat(frames, edges, axis=0)
+        else:
+            mins = np.zeros((n_stems, width, 2), dtype=np.float32)
+            maxs = np.zeros((n_stems, width, 2), dtype=np.float32)
+            for i, pyramid in enumerate(self.pyramids):
+                # Stems that haven't been analysed yet stay flat
+                if pyramid is not None:
+                    mins[i], maxs[i] = pyramid.envelope(start, stop, width)
+
+        self._envelopes = ((width, start, stop), mins, maxs)
+        return mins, maxs
+
     def update_audio_data(self):
-        n = [self.track_to_graph]
+        if self.stem_store is None or self.graph is None:
+            return
+
+        width = max(self.graph.width(), 1)
+        start, stop = self._visible_frames()
+        stem_mins, stem_maxs = self._stem_envelopes(width, start, stop)
+
+        if self.track_to_graph == -1:
+            # The sum of the stems as they are heard, weighted by their mixer gains
+            gains = np.ones(len(self.stem_store), dtype=np.float32) if self.track_gains is None else self.track_gains
+            mins = np.tensordot(gains, stem_mins, axes=1)
+            maxs = np.tensordot(gains, stem_maxs, axes=1)
+        else:
+            mins = stem_mins[self.track_to_graph]
+            maxs = stem_maxs[self.track_to_graph]
+
+        start_time = start / self.stem_store.sample_rate
+        stop_time = stop / self.stem_store.sample_rate
+
+        if stem_mins is stem_maxs:
+            # Single frames are connected into a continuous line
+            self.times = np.linspace(start_time, stop_time, num=len(mins), endpoint=False)
+            self.amplitudes_l = mins[:, 0]
+            self.amplitudes_r = mins[:, 1]
+            connect = "all"
+        else:
+            # Every pixel column is drawn as a vertical line from its minimum to its maximum
+            self.times = np.repeat(np.linspace(start_time, stop_time, num=width, endpoint=False), 2)
+            self.amplitudes_l = np.ravel(np.column_stack((mins[:, 0], maxs[:, 0])))
+            self.amplitudes_r = np.ravel(np.column_stack((mins[:, 1], maxs[:, 1])))
+            connect = "pairs"
+
+        self.plot_l.setData(self.times, self.amplitudes_l, connect=connect)
+        self.plot_r.setData(self.times, self.amplitudes_r, connect=connect)
+        self.graph.setXRange(start_time, stop_time, padding=0)
+
+        self.tracker.invalidate()
+
+    def update_source(self, stem_store):
+        self.stem_store = stem_store
+        self.pyramids = [None] * len(stem_store)
+        self._final = [False] * len(stem_store)
+        self._envelopes = None
+        self._start_analysis()
+        self.update_audio_data()
+
+    def setTrackToGraph(self, track):
+        self.track_to_graph = track
+
+        # Move the newly shown stem to the front of a running analysis
+        if track != -1 and self.stem_store is not None and not self._final[track]:
+            self._start_analysis()
+
+        self.update_audio_data()
+
+    def stopAnalysis(self, wait=False):
+        """
+        wait: block until the workers are done, before shutting down
+        """
+        self._generation += 1
+        for worker in self._workers:
+            worker.requestInterruption()
+        if wait:
+            for worker in self._workers:
+                worker.wait()
+
+    def _start_analysis(self):
+        self.stopAnalysis()
+
+        order = [i for i in range(len(self.stem_store)) if not self._final[i]]
+        if len(order) == 0:
+            return
+
+        # The stem on display comes first
+        if self.track_to_graph in order:
+            order.remove(self.track_to_graph)
+            order.insert(0, self.track_to_graph)
+
+        worker = _PeakWorker(self._generation, self.stem_store, order, self)
+        worker.pyramidReady.connect(self._pyramid_ready)
+        worker.saved.connect(lambda generation: self.peaksSaved.emit() if generation == self._generation else None)
+        worker.finished.connect((lambda worker: lambda: self._worker_finished(worker))(worker))
+        self._workers.append(worker)
+        worker.start()
+
+    def _worker_finished(self, worker):
+        self._workers.remove(worker)
+        worker.deleteLater()
+
+    def _pyramid_ready(self, generation, index, pyramid, final):
+        # Results of a cancelled analysis
+        if generation != self._generation:
+            return
+
+        self.pyramids[index] = pyramid
+        self._final[index] = final
+        self._envelopes = None
+        self.update_audio_data()
+
+    def setTrackGains(self, gains):
+        self.track_gains = np.asarray(gains, dtype=np.float32)
+
         if self.track_to_graph == -1:
-            n = range(len(self.players))
-
-        self.times = []
-        self.amplitudes_l = []
-        self.amplitudes_r = []
-            
-        for i in n:
-            wav_obj = wave.open(self.players[i].source().path(), "rb")
-            sample_rate = wav_obj.getframerate()
-            n_samples = wav_obj.getnframes()
-            t_audio = n_samples/sample_rate
-            n_channels = wav_obj.getnchannels()
-            signal_wave = wav_obj.readframes(n_samples)
-            signal_array = np.frombuffer(signal_wave, dtype=np.int16)
-
-            l_channel = signal_array[0::2]
-            r_channel = signal_array[1::2]
-            times = np.linspace(0, n_samples/sample_rate, num=n_samples)
-
-            indicies = np.linspace(0, len(times) - 1, self.n_visual_samples, dtype=int)
-
-            if (self.times is None) or (len(self.times) == 0):
-                self.times = times[indicies]
-                self.amplitudes_l = l_channel[indicies]
-                self.amplitudes_r = r_channel[indicies]
-            else:
-                self.times = np.add(self.times, times[indicies])
-                self.amplitudes_l = np.add(self.amplitudes_l, l_channel[indicies])
-                self.amplitudes_r = np.add(self.amplitudes_r, r_channel[indicies])
-
-        self.plot_l.setData(self.times, self.amplitudes_l)
-        self.plot_r.setData(self.times, self.amplitudes_r)
-
-        self.paintEvent(None)
-
-    def update_source(self):
+            self.update_audio_data()
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
         self.update_audio_data()
 
     def setBackgroundColor(self, color):
         self.bg_color = color
-        self.graph.setBackground(self.bg_color)
-        self.graph.update()
-        self.update()
+        if self.graph is not None:
+            self.graph.setBackground(self.bg_color)
+            self.graph.update()
+        self.tracker.invalidate()
 
     def setForegroundColor(self, color):
         self.fg_color = color
         self.pen.setColor(QtGui.QColor.fromRgb(self.fg_color.red(), self.fg_color.green(), self.fg_color.blue(), 40))
         alt_color = QtGui.QColor.fromHsl(self.fg_color.hue(), self.fg_color.saturation() - 30, self.fg_color.lightness() - 30)
         self.pen_alt.setColor(QtGui.QColor.fromRgb(alt_color.red(), alt_color.green(), alt_color.blue(), 40))
-        self.graph.update()
-        self.update()
+        if self.graph is not None:
+            self.graph.update()
+        self.tracker.invalidate()
         
     def setPlayer(self, player):
         self.player = player
     
-    def setVisualSampleCount(self, num_samples):
-        self.n_visual_samples = num_samples
-
     def setOrientation(self, orientation):
         print(f"Warning: TrackerWidget.setOrientation stub. Value {orientation}")
 
@@ -233,7 +587,11 @@ class TrackerWidget(QtWidgets.QWidget):
             self._position = maximum
 
         self._maximum = maximum
-        self.update()
+        self._view_start = self._minimum
+        self._view_end = maximum
+        self.update_audio_data()
+        self.tracker.invalidate()
+        self.tracker.movePlayhead()
 
     def setMinimum(self, minimum):
         if minimum > self.maximum:
@@ -244,7 +602,7 @@ class TrackerWidget(QtWidgets.QWidget):
             self.position = minimum
 
         self.minimum = minimum
-        self.tracker.update()
+        self.tracker.invalidate()
 
     def position(self):
         return self._position
@@ -255,7 +613,13 @@ class TrackerWidget(QtWidgets.QWidget):
             return
 
         self._position = position
-        self.tracker.update()
+
+        # Page along with playback when zoomed in
+        if self.isZoomed() and not (self._view_start <= position <= self._view_end):
+            span = self._view_end - self._view_start
+            self.setViewRange(position, position + span)
+
+        self.tracker.movePlayhead()
 
     def minimum(self):
         return self._minimum
@@ -263,22 +627,20 @@ class TrackerWidget(QtWidgets.QWidget):
     def maximum(self):
         return self._maximum
     
-    def addCheckpoint(self, index, position, color):
-        self.checkpoints[index] = (position, color)
-        self.tracker.update()
+    def setMarkers(self, markers):
+        """
+        markers: MarkerStore to draw, updateMarkers has to be called after changing it
+        """
+        self.markers = markers
+        self.tracker.invalidate()
 
-    def removeCheckpoint(self, index):
-        del self.checkpoints[index]
-        self.tracker.update()
-    
-    def removeCheckpoints(self):
-        self.checkpoints = {}
-        self.tracker.update()
+    def updateMarkers(self):
+        self.tracker.invalidate()
 
     def setLoop(self, loop):
         self.loop = loop
-        self.tracker.update()
+        self.tracker.invalidate()
 
     def removeLoop(self):
         self.loop = None
-        self.tracker.update()
+        self.tracker.invalidate()
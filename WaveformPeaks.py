@@ -0,0 +1,272 @@
+import math
+import os
+import struct
+import threading
+from os import path
+
+import numpy as np
+
+
+BASE_BLOCK_SIZE = 64
+LEVEL_FACTOR = 4
+CHUNK_SIZE = BASE_BLOCK_SIZE * 16384
+
+SIDECAR_EXTENSION = ".peaks"
+SIDECAR_MAGIC = b"SPTP"
+SIDECAR_VERSION = 1
+# magic, version, channels, sample rate, frames, base block size, source size, source mtime
+SIDECAR_HEADER = struct.Struct("<4sHHIQIQq")
+
+
+def block_peaks(data, block_size=BASE_BLOCK_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Minimum and maximum of every block of frames in a (frames, channels) array.
+    Works through the data in chunks so a mapped file is never copied whole.
+    """
+    n_frames, n_channels = data.shape
+    n_blocks = math.ceil(n_frames / block_size)
+    mins = np.empty((n_blocks, n_channels), dtype=data.dtype)
+    maxs = np.empty((n_blocks, n_channels), dtype=data.dtype)
+
+    for start in range(0, n_frames, chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size])
+        first_block = start // block_size
+        n_full = len(chunk) // block_size
+
+        # Reducing one channel at a time keeps the reduction over the
+        # innermost axis, several times faster than reducing interleaved frames
+        for channel in range(n_channels if n_full > 0 else 0):
+            blocks = chunk[:n_full * block_size, channel].reshape(n_full, block_size)
+            mins[first_block:first_block + n_full, channel] = blocks.min(axis=1)
+            maxs[first_block:first_block + n_full, channel] = blocks.max(axis=1)
+
+        # Only the last chunk can end in a partial block
+        if n_full * block_size < len(chunk):
+            mins[first_block + n_full] = chunk[n_full * block_size:].min(axis=0)
+            maxs[first_block + n_full] = chunk[n_full * block_size:].max(axis=0)
+
+    return mins, maxs
+
+
+def _reduce(mins, maxs, factor=LEVEL_FACTOR):
+    padding = -len(mins) % factor
+    if padding:
+        mins = np.concatenate([mins, np.repeat(mins[-1:], padding, axis=0)])
+        maxs = np.concatenate([maxs, np.repeat(maxs[-1:], padding, axis=0)])
+
+    n_channels = mins.shape[1]
+    return (
+        mins.reshape(-1, factor, n_channels).min(axis=1),
+        maxs.reshape(-1, factor, n_channels).max(axis=1),
+    )
+
+
+class PeakPyramid:
+    """
+    Min/max envelopes of a stem at decreasing resolutions. Level 0 holds
+    the peaks of every BASE_BLOCK_SIZE frames, each level above combines
+    LEVEL_FACTOR buckets of the one below. Drawing picks the level closest
+    to the display resolution, so no transient is ever skipped and the
+    work only depends on the number of pixels.
+    """
+
+    def __init__(self, mins, maxs, n_frames, sample_rate):
+        self.n_frames = n_frames
+        self.sample_rate = sample_rate
+
+        self.levels = [(mins.astype(np.float32), maxs.astype(np.float32))]
+        while len(self.levels[-1][0]) > 1:
+            self.levels.append(_reduce(*self.levels[-1]))
+
+    @classmethod
+    def from_stem(cls, stem, n_frames=None):
+        builder = PeakBuilder(stem, n_frames, estimate=False)
+        while not builder.done():
+            builder.step()
+        return builder.pyramid()
+
+    def block_size(self, level):
+        return BASE_BLOCK_SIZE * LEVEL_FACTOR**level
+
+    def level_for(self, frames_per_pixel):
+        level = 0
+        while level + 1 < len(self.levels) and self.block_size(level + 1) <= frames_per_pixel:
+            level += 1
+        return level
+
+    def envelope(self, start, stop, width):
+        """
+        Minimum and maximum per pixel column, as two (width, channels) arrays
+        start, stop: Range of frames to show
+        """
+        level = self.level_for((stop - start) / width)
+        block_size = self.block_size(level)
+        mins, maxs = self.levels[level]
+
+        first = min(start // block_size, len(mins) - 1)
+        last = min(math.ceil(stop / block_size), len(mins))
+        last = max(last, first + 1)
+
+        # First bucket of every pixel column, relative to the visible range
+        edges = np.linspace(start, stop, width, endpoint=False) // block_size - first
+        edges = np.clip(edges.astype(np.int64), 0, last - first - 1)
+
+        return (
+            np.minimum.reduceat(mins[first:last], edges, axis=0),
+            np.maximum.reduceat(maxs[first:last], edges, axis=0),
+        )
+
+    def save(self, file_name, source_file_name):
+        """
+        Write the finest level as a sidecar file, the coarser levels
+        are cheap to rebuild from it. Peaks are stored as float16.
+        """
+        stat = os.stat(source_file_name)
+        mins, maxs = self.levels[0]
+        header = SIDECAR_HEADER.pack(
+            SIDECAR_MAGIC, SIDECAR_VERSION, mins.shape[1], self.sample_rate,
+            self.n_frames, BASE_BLOCK_SIZE, stat.st_size, stat.st_mtime_ns,
+        )
+
+        # Unique per thread, a cancelled analysis may still be finishing the same file
+        temp_file = f"{file_name}.{threading.get_ident()}.tmp"
+        with open(temp_file, "wb") as f:
+            f.write(header)
+            f.write(mins.astype(np.float16).tobytes())
+            f.write(maxs.astype(np.float16).tobytes())
+        os.replace(temp_file, file_name)
+
+    @classmethod
+    def load(cls, file_name, source_file_name):
+        """
+        Returns None if the sidecar is missing, from another version,
+        or was made for a different source file
+        """
+        if not path.isfile(file_name):
+            return None
+
+        stat = os.stat(source_file_name)
+
+        with open(file_name, "rb") as f:
+            header = f.read(SIDECAR_HEADER.size)
+            if len(header) < SIDECAR_HEADER.size:
+                return None
+
+            magic, version, n_channels, sample_rate, n_frames, block_size, size, mtime = SIDECAR_HEADER.unpack(header)
+            if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or block_size != BASE_BLOCK_SIZE:
+                return None
+            if size != stat.st_size or mtime != stat.st_mtime_ns:
+                return None
+
+            n_values = math.ceil(n_frames / BASE_BLOCK_SIZE) * n_channels
+            peaks = np.fromfile(f, dtype=np.float16, count=n_values * 2)
+
+        if len(peaks) != n_values * 2:
+            return None
+
+        mins = peaks[:n_values].reshape(-1, n_channels)
+        maxs = peaks[n_values:].reshape(-1, n_channels)
+        return cls(mins, maxs, n_frames, sample_rate)
+
+
+class PeakBuilder:
+    """
+    Builds the peaks of a stem a chunk at a time. Until a block is
+    reached it holds an estimate from short windows spread evenly
+    over the stem, so a usable overview exists from the start. Stems
+    that aren't mapped into memory would have to be decoded almost
+    whole for that, they start out flat instead.
+    """
+
+    coarse_points = 16384
+
+    def __init__(self, stem, n_frames=None, estimate=True):
+        """
+        n_frames: Frames from the start of the stem to build, all of them if None
+        estimate: Whether to start from an estimate, without one the peaks start out flat
+        """
+        self.stem = stem
+        self.n_frames = stem.n_frames if n_frames is None else n_frames
+        self.position = 0
+
+        n_blocks = math.ceil(self.n_frames / BASE_BLOCK_SIZE)
+        self.mins = np.zeros((n_blocks, stem.n_channels), dtype=stem.dtype)
+        self.maxs = np.zeros((n_blocks, stem.n_channels), dtype=stem.dtype)
+
+        if estimate and stem.mapped and n_blocks > 0:
+            self._estimate()
+
+    def _estimate(self):
+        n_blocks = len(self.mins)
+        step = max(1, n_blocks // self.coarse_points)
+
+        # One block read every step blocks, stretched over the skipped ones
+        frames = np.arange(0, n_blocks, step)[:, None] * BASE_BLOCK_SIZE + np.arange(BASE_BLOCK_SIZE)
+        frames = np.minimum(frames, self.n_frames - 1)
+        windows = self.stem.data[frames.ravel()].reshape(frames.shape[0], BASE_BLOCK_SIZE, self.stem.n_channels)
+
+        self.mins[:] = np.repeat(windows.min(axis=1), step, axis=0)[:n_blocks]
+        self.maxs[:] = np.repeat(windows.max(axis=1), step, axis=0)[:n_blocks]
+
+    def done(self):
+        return self.position >= self.n_frames
+
+    def progress(self):
+        return min(self.position / max(self.n_frames, 1), 1)
+
+    def step(self):
+        start = self.position
+        stop = min(start + CHUNK_SIZE, self.n_frames)
+        mins, maxs = block_peaks(self.stem.read(start, stop))
+
+        first_block = start // BASE_BLOCK_SIZE
+        self.mins[first_block:first_block + len(mins)] = mins
+        self.maxs[first_block:first_block + len(maxs)] = maxs
+        self.position = stop
+
+    def pyramid(self):
+        scale = np.float32(self.stem.scale)
+        return PeakPyramid(self.mins * scale, self.maxs * scale, self.n_frames, self.stem.sample_rate)
+
+
+def sidecar_path(stem_file_name):
+    return path.splitext(stem_file_name)[0] + SIDECAR_EXTENSION
+
+
+def load_sidecar(stem):
+    """
+    Peak pyramid of a stem from its sidecar file, None if it's missing or out of date
+    """
+    if stem.file_name is None:
+        return None
+
+    try:
+        return PeakPyramid.load(sidecar_path(stem.file_name), stem.file_name)
+    except (OSError, ValueError):
+        return None
+
+
+def save_sidecar(stem, pyramid):
+    # Stems only in memory have nowhere to keep one
+    if stem.file_name is None:
+        return
+
+    sidecar = sidecar_path(stem.file_name)
+
+    try:
+        pyramid.save(sidecar, stem.file_name)
+    except OSError as e:
+        print(f"Warning: Could not write waveform peaks {sidecar}. {e}")
+
+
+def load_or_build(stem):
+    """
+    Peak pyramid of a stem, read from its sidecar file when it's up to date
+    """
+    pyramid = load_sidecar(stem)
+    if pyramid is not None:
+        return pyramid
+
+    pyramid = PeakPyramid.from_stem(stem)
+    save_sidecar(stem, pyramid)
+    return pyramid
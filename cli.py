@@ -0,0 +1,213 @@
+"""
+Headless preprocessing of songs: instrument separation, waveform peaks
+and beat analysis, without creating any Qt objects. Progress is printed
+to stdout as one JSON object per line.
+
+    python cli.py [options] FILE_OR_DIRECTORY...
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import Separation
+from StemCache import DEFAULT_BUDGET, StemCache
+
+
+STEPS = ["separate", "peaks", "beats"]
+
+
+def emit(event, **fields):
+    print(json.dumps({"event": event, **fields}), flush=True)
+
+
+def separate(file_name, key, profile, out_dir, stem_format, jobs, threads, progress):
+    """
+    Runs demucs in its own process, like the GUI does
+    Returns an error message, None on success
+    """
+    command = Separation.demucs_command(file_name, key, profile.model, out_dir, profile.options(), jobs, stem_format)
+    environment = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    parser = Separation.ProgressParser(profile.model, profile.shifts)
+
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=environment)
+    except OSError as e:
+        return f"Could not start demucs. {e}"
+
+    # tqdm redraws with carriage returns, so read whatever has arrived
+    output = []
+    while True:
+        chunk = process.stdout.read1(4096)
+        if not chunk:
+            break
+
+        text = chunk.decode("utf-8", errors="replace")
+        output.append(text)
+        percent = parser.feed(text)
+        if percent is not None:
+            progress.put(("progress", {"file": file_name, "step": "separate", "percent": percent}))
+
+    if process.wait() != 0:
+        return "".join(output)[-500:].strip() or f"demucs exited with code {process.returncode}"
+
+    if not Separation.is_separated(Separation.separated_dir(key, profile.model, out_dir)):
+        return "demucs did not write all stems"
+
+    return None
+
+
+def process_song(file_name, key, separated_dir, profile, out_dir, stem_format, steps, jobs, threads, progress):
+    """
+    Runs the requested steps for one song in a pool worker
+    Returns the steps that were completed and an error message or None
+    """
+    # Imported here so only the workers pay for NumPy
+    import BeatTracker
+    import WaveformPeaks
+    from StemStore import StemStore
+
+    done = []
+
+    if "separate" in steps and not Separation.is_separated(separated_dir):
+        progress.put(("started", {"file": file_name, "step": "separate"}))
+        error = separate(file_name, key, profile, out_dir, stem_format, jobs, threads, progress)
+        if error is not None:
+            return done, error
+        done.append("separate")
+
+    if not Separation.is_separated(separated_dir):
+        return done, "Song is not separated"
+
+    try:
+        store = StemStore(Separation.stem_paths(separated_dir))
+
+        if "peaks" in steps:
+            progress.put(("started", {"file": file_name, "step": "peaks"}))
+            for stem in store:
+                WaveformPeaks.load_or_build(stem)
+            done.append("peaks")
+
+        if "beats" in steps:
+            progress.put(("started", {"file": file_name, "step": "beats"}))
+            grid = BeatTracker.load_or_detect(store[Separation.STEMS.index("drums")], separated_dir)
+            progress.put(("beats", {"file": file_name, "bpm": round(grid.bpm, 2), "beats": len(grid), "offset": grid.offset()}))
+            done.append("beats")
+    except (OSError, ValueError) as e:
+        return done, str(e)
+
+    return done, None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Separate and analyse songs without the GUI.")
+    parser.add_argument("paths", nargs="+", help="audio files, or directories to search for them")
+    parser.add_argument("-s", "--steps", default=",".join(STEPS), help=f"comma separated steps to run, out of {','.join(STEPS)}")
+    parser.add_argument("-p", "--profile", choices=list(Separation.PROFILES), default=Separation.DEFAULT_PROFILE, help="separation profile, preview is fast and quality is best")
+    parser.add_argument("-m", "--model", default=None, help="demucs model, instead of the profile's")
+    parser.add_argument("--shifts", type=int, default=None, help="random shifts averaged by demucs, instead of the profile's")
+    parser.add_argument("--segment", type=int, default=None, help="seconds of audio demucs separates at once, instead of the profile's")
+    parser.add_argument("--overlap", type=float, default=None, help="overlap between segments from 0 to 1, instead of the profile's")
+    parser.add_argument("-f", "--format", choices=list(Separation.STEM_FORMATS), default=Separation.DEFAULT_STEM_FORMAT, help="file format of the stems")
+    parser.add_argument("-o", "--out-dir", default=Separation.DEFAULT_OUTPUT_DIR, help="directory the stems are written to")
+    parser.add_argument("--cache-budget", type=float, default=None, help=f"GiB of stems kept, least recently used songs are removed past it (default {DEFAULT_BUDGET / 1024**3:g})")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="songs processed at the same time")
+    parser.add_argument("--segment-jobs", type=int, default=None, help="segments of each song separated in parallel")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="CPU threads of each segment job")
+
+    args = parser.parse_args(argv)
+    args.profile = Separation.PROFILES[args.profile].replace(args.model, args.shifts, args.segment, args.overlap)
+    args.steps = [step.strip() for step in args.steps.split(",") if step.strip()]
+    for step in args.steps:
+        if step not in STEPS:
+            parser.error(f"unknown step '{step}'")
+    if args.cache_budget is not None and args.cache_budget <= 0:
+        parser.error("--cache-budget must be more than 0")
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    files = []
+    failed = 0
+    for name in args.paths:
+        if os.path.isdir(name):
+            files.extend(Separation.find_audio_files(name))
+        elif os.path.isfile(name):
+            files.append(name)
+        else:
+            emit("failed", file=name, message="No such file or directory")
+            failed += 1
+
+    jobs = args.jobs if args.jobs is not None else Separation.max_concurrent_jobs()
+    jobs = max(1, min(jobs, len(files) or 1))
+
+    # Cores left over by the songs go to separating segments of each song in parallel
+    segment_jobs, threads = Separation.split_cores(jobs)
+    if args.segment_jobs is not None:
+        segment_jobs = max(1, args.segment_jobs)
+        threads = max(1, (os.cpu_count() or 1) // (jobs * segment_jobs))
+    if args.threads is not None:
+        threads = max(1, args.threads)
+
+    # The GUI may use the cache at the same time, the index is merged on every write
+    cache = StemCache(args.out_dir, DEFAULT_BUDGET if args.cache_budget is None else int(args.cache_budget * 1024**3))
+
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=jobs) as pool:
+        progress = manager.Queue()
+        futures = {}
+
+        for file_name in files:
+            key, separated_dir, cached = cache.lookup(file_name, args.profile.model, args.profile.options())
+            emit("queued", file=file_name, key=key, cached=cached)
+
+            future = pool.submit(process_song, file_name, key, separated_dir, args.profile, args.out_dir, args.format, args.steps, segment_jobs, threads, progress)
+            futures[future] = (file_name, key)
+
+        pending = set(futures)
+        while pending:
+            try:
+                event, fields = progress.get(timeout=0.2)
+                emit(event, **fields)
+                continue
+            except queue.Empty:
+                pass
+
+            for future in [future for future in pending if future.done()]:
+                pending.discard(future)
+                file_name, key = futures[future]
+
+                # Progress of the song may still be queued
+                while not progress.empty():
+                    event, fields = progress.get()
+                    emit(event, **fields)
+
+                try:
+                    done, error = future.result()
+                except Exception as e:
+                    done, error = [], f"Worker crashed. {e}"
+
+                if "separate" in done:
+                    cache.add(key, args.profile.model)
+                elif len(done) > 0:
+                    cache.measure(key)
+
+                if error is None:
+                    emit("done", file=file_name, steps=done)
+                else:
+                    failed += 1
+                    emit("failed", file=file_name, steps=done, message=error)
+
+    emit("finished", files=len(files), failed=failed)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
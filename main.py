@@ -1,11 +1,15 @@
+import os
 import sys
+import time
 from os import path
-import math
 from datetime import datetime
 
-from PyQt6.QtCore import Qt, QSize, QUrl, QTimer
+# Set SPT_STARTUP_TIMING=1 to print how long the window took to appear
+startup_time = time.perf_counter()
+
+from PyQt6.QtCore import Qt, QSize, QTimer, QObject, QEvent, QSettings
 from PyQt6.QtGui import QIcon, QPalette, QColor, QFont, QKeySequence
-from PyQt6.QtMultimedia import QAudioOutput, QMediaPlayer, QMediaTimeRange
+from PyQt6.QtMultimedia import QMediaPlayer
 from PyQt6.QtWidgets import (
     QApplication,
     QWidget,
@@ -24,10 +28,18 @@ from PyQt6.QtWidgets import (
     QComboBox,
     QLineEdit,
     QSpinBox,
+    QMenu,
+    QInputDialog,
 )
 
-import demucs.separate
-
+import Separation
+from SeparationWorker import SeparationJob
+from SeparationQueue import SeparationQueue
+from StemCache import StemCache, DEFAULT_BUDGET
+from MarkerStore import MarkerStore, Marker
+import Session
+from AudioEngine import AudioEngine
+from StemStore import StemStore
 from MixerWidget import MixerWidget
 from TrackerWidget import TrackerWidget
 from ColorButton import ColorButton
@@ -38,18 +50,48 @@ class MainWindow(QMainWindow):
 
     media_filename = ""
     media_separated_dir = ""
+    media_key = None
+    # Cache key of the stems playing, None for the original
+    media_stem_key = None
     media_state = "inactive"
     media_duration = 0
     media_position = 0
 
     master_track_volume = 1
 
-    checkpoints = {}
     checkpoint_colors = ["#a6e3a1", "#89b4fa", "#f9e2af", "#f5c2e7", "#fab387", "#94e2d5"]
+    marker_color = "#cdd6f4"
+    bar_marker_color = "#6c7086"
     loop = None
+    # Milliseconds from the playhead a marker can be to be renamed or deleted
+    marker_reach = 500
+
+    separation_job = None
+    # Decodes the original of a song that is played until it's separated
+    mix_decoder = None
+    # Profiles still to run for the song being separated, after the current job
+    separation_pending = []
+    separation_session_key = None
+    # Which stems are made when a new song is opened
+    separation_modes = [
+        ("Preview, then quality", ["preview", "quality"]),
+        ("Quality", ["quality"]),
+        ("Preview", ["preview"]),
+    ]
+
+    beat_worker = None
+    beat_grid = None
+    active_beat_grid = None
+    metronome_enabled = False
+    # Where the tempo fields got their values: None while they only hold
+    # the default, "detected" by beat detection or "user" when set on purpose
+    tempo_source = None
+    _setting_tempo = False
+
+    # Milliseconds after the last change before the session is written
+    session_save_delay = 1000
 
     start_delay_timer = QTimer()
-    loop_delay_timer = QTimer()
 
     def __init__(self):
         super().__init__()
@@ -90,9 +132,37 @@ class MainWindow(QMainWindow):
         self.song_select_button = QPushButton(QIcon.fromTheme("document-open"), "Browse...")
         self.song_select_button.setFixedSize(QSize(100, 30))
 
+        self.separation_mode_select = QComboBox()
+        self.separation_mode_select.addItems([name for name, _ in self.separation_modes])
+        self.separation_mode_select.setToolTip("Stems made for new songs. A fast preview plays within seconds and is replaced by quality stems once they're done")
+
         self.song_select_label = QLabel("No song selected")
         self.song_select_label.setFont(QFont("sans-serif", italic=True))
 
+        self.separation_label = QLabel("")
+        self.separation_label.setVisible(False)
+        self.separation_cancel_button = QPushButton(QIcon.fromTheme("process-stop"), "")
+        self.separation_cancel_button.setToolTip("Cancel separation")
+        self.separation_cancel_button.setFixedSize(QSize(30, 30))
+        self.separation_cancel_button.setVisible(False)
+
+        self.queue_files_button = QPushButton(QIcon.fromTheme("list-add"), "Queue...")
+        self.queue_files_button.setToolTip("Separate a list of songs in the background")
+        self.queue_files_button.setFixedSize(QSize(100, 30))
+        self.queue_folder_button = QPushButton(QIcon.fromTheme("folder-open"), "")
+        self.queue_folder_button.setToolTip("Separate every song in a folder in the background")
+        self.queue_folder_button.setFixedSize(QSize(30, 30))
+        self.queue_label = QLabel("")
+        self.queue_label.setVisible(False)
+        self.queue_cancel_button = QPushButton(QIcon.fromTheme("process-stop"), "")
+        self.queue_cancel_button.setToolTip("Cancel the songs in the queue that aren't separated yet")
+        self.queue_cancel_button.setFixedSize(QSize(30, 30))
+        self.queue_cancel_button.setVisible(False)
+        self.queue_clear_button = QPushButton(QIcon.fromTheme("edit-clear"), "")
+        self.queue_clear_button.setToolTip("Remove separated songs from the queue")
+        self.queue_clear_button.setFixedSize(QSize(30, 30))
+        self.queue_clear_button.setVisible(False)
+
         self.soundwave_select = QComboBox()
         self.soundwave_select.addItems(["All", "Drums", "Bass", "Vocals", "Other"])
 
@@ -118,6 +188,28 @@ class MainWindow(QMainWindow):
 
             self.checkpoint_buttons.append((checkpoint_set, checkpoint_load))
 
+        # Named markers aren't limited to the checkpoint slots
+        self.marker_add_button = ColorButton("+")
+        self.marker_add_button.setFixedSize(checkpoint_button_size)
+        self.marker_add_button.setToolTip("Add a rehearsal marker")
+        self.marker_add_button.setHighlighted(False)
+        self.marker_add_button.setShortcut(QKeySequence.fromString("N"))
+        self.marker_bars_button = ColorButton("|")
+        self.marker_bars_button.setFixedSize(checkpoint_button_size)
+        self.marker_bars_button.setToolTip("Mark every bar")
+        self.marker_bars_button.setHighlightColor(self.bar_marker_color)
+        self.marker_bars_button.setHighlighted(False)
+        self.marker_delete_button = ColorButton("−")
+        self.marker_delete_button.setFixedSize(checkpoint_button_size)
+        self.marker_delete_button.setToolTip("Delete the marker at the playhead")
+        self.marker_delete_button.setHighlighted(False)
+        self.marker_delete_button.setShortcut(QKeySequence.fromString("Shift+N"))
+        self.marker_rename_button = ColorButton("✎")
+        self.marker_rename_button.setFixedSize(checkpoint_button_size)
+        self.marker_rename_button.setToolTip("Rename the marker at the playhead")
+        self.marker_rename_button.setHighlighted(False)
+        self.marker_rename_button.setShortcut(QKeySequence.fromString("F2"))
+
         # FIXME: Add actions for keyboard shortcuts so they can have multiple keys for one action
         # FIXME: Add media button controls
         self.media_button_size = QSize(40, 40)
@@ -149,6 +241,12 @@ class MainWindow(QMainWindow):
         self.min_speed_label = QLabel("x0")
         self.max_speed_label = QLabel("x2")
         self.speed_ctrl_slider = QSlider(Qt.Orientation.Horizontal)
+        self.transpose_label = QLabel("Transpose")
+        self.transpose_input = QSpinBox()
+        self.transpose_input.setRange(-12, 12)
+        self.transpose_input.setValue(0)
+        self.transpose_input.setSuffix(" st")
+        self.transpose_input.setToolTip("Shift the pitch by semitones without changing the speed")
         
         self.speed_ctrl_buttons = []
         speed_ctrl_button_size = QSize(40, 25)
@@ -174,9 +272,13 @@ class MainWindow(QMainWindow):
         self.bpm_input.setValue(100)
         self.bpm_offset_label = QLabel("Offset")
         self.bpm_offset_input = QSpinBox()
-        self.bpm_offset_input.setRange(-1000, 1000)
+        self.bpm_offset_input.setRange(-10000, 10000)
         self.bpm_offset_input.setValue(0)
         self.bpm_offset_input.setSuffix("ms")
+        self.snap_label = QLabel("Snap")
+        self.snap_select = QComboBox()
+        self.snap_select.addItems(['Off', 'Beat', 'Bar'])
+        self.snap_select.setToolTip("Snap checkpoints and loops to the beat grid")
         self.delay_label = QLabel("Start/Loop delay")
         self.start_delay_label = QLabel("Start")
         self.start_delay_input = QSpinBox()
@@ -208,12 +310,18 @@ class MainWindow(QMainWindow):
         self.mixer_other.setBackgroundColor(palette.base().color())
         self.mixer_other.setColor(palette.highlight().color())
         self.mixer_other.setMuteShortcut(QKeySequence.fromString("/"))
+        self.mixer_click = MixerWidget(labelText="Click")
+        self.mixer_click.setBackgroundColor(palette.base().color())
+        self.mixer_click.setColor(palette.highlight().color())
         self.mixer_master = MixerWidget(labelText="Master")
         self.mixer_master.setBackgroundColor(palette.base().color())
         self.mixer_master.setColor(palette.highlight().color())
 
         self.settings_button = QPushButton(QIcon.fromTheme("document-properties"), "")
         self.settings_button.setFixedSize(QSize(30, 30))
+        self.settings_menu = QMenu(self.settings_button)
+        self.cache_budget_action = self.settings_menu.addAction("Stem cache size...")
+        self.settings_button.setMenu(self.settings_menu)
         self.footer_spacer = QSpacerItem(10, 10, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
         self.notation_view_button = QPushButton(QIcon.fromTheme("go-next"), "Notation View")
         self.notation_view_button.setLayoutDirection(Qt.LayoutDirection.RightToLeft)
@@ -230,7 +338,15 @@ class MainWindow(QMainWindow):
 
         # Widget placement
         self.song_select_section.addWidget(self.song_select_button)
+        self.song_select_section.addWidget(self.separation_mode_select)
         self.song_select_section.addWidget(self.song_select_label)
+        self.song_select_section.addWidget(self.separation_label)
+        self.song_select_section.addWidget(self.separation_cancel_button)
+        self.song_select_section.addWidget(self.queue_files_button)
+        self.song_select_section.addWidget(self.queue_folder_button)
+        self.song_select_section.addWidget(self.queue_label)
+        self.song_select_section.addWidget(self.queue_cancel_button)
+        self.song_select_section.addWidget(self.queue_clear_button)
 
         self.song_select_section.addSpacerItem(QSpacerItem(10, 10, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum))
         self.song_select_section.addWidget(self.soundwave_select)
@@ -238,6 +354,10 @@ class MainWindow(QMainWindow):
         for i, buttons in enumerate(self.checkpoint_buttons):
             self.checkpoint_section.addWidget(buttons[0], 0, i)
             self.checkpoint_section.addWidget(buttons[1], 1, i)
+        self.checkpoint_section.addWidget(self.marker_add_button, 0, self.num_checkpoints)
+        self.checkpoint_section.addWidget(self.marker_bars_button, 1, self.num_checkpoints)
+        self.checkpoint_section.addWidget(self.marker_delete_button, 0, self.num_checkpoints + 1)
+        self.checkpoint_section.addWidget(self.marker_rename_button, 1, self.num_checkpoints + 1)
 
         self.media_ctrl_section.addWidget(self.media_ctrl_loop)
         self.media_ctrl_section.addWidget(self.media_ctrl_ld_back)
@@ -252,29 +372,34 @@ class MainWindow(QMainWindow):
         self.speed_fine_section.addWidget(self.min_speed_label)
         self.speed_fine_section.addWidget(self.speed_ctrl_slider)
         self.speed_fine_section.addWidget(self.max_speed_label)
+        self.speed_fine_section.addWidget(self.transpose_label)
+        self.speed_fine_section.addWidget(self.transpose_input)
 
         for button, speed in self.speed_ctrl_buttons:
             self.speed_coarse_section.addWidget(button)
 
         self.timing_section.addWidget(self.metronome_label, 0, 0, 1, 2)
-        self.timing_section.addWidget(self.delay_label, 0, 7, 1, 2)
+        self.timing_section.addWidget(self.delay_label, 0, 9, 1, 2)
         self.timing_section.addWidget(self.metronome_sync_button, 1, 0)
         self.timing_section.addWidget(self.metronome_play_button, 1, 1)
         self.timing_section.addWidget(self.bpm_label, 1, 2)
         self.timing_section.addWidget(self.bpm_input, 1, 3)
         self.timing_section.addWidget(self.bpm_offset_label, 1, 4)
         self.timing_section.addWidget(self.bpm_offset_input, 1, 5)
-        self.timing_section.addItem(QSpacerItem(10, 10, QSizePolicy.Policy.MinimumExpanding, QSizePolicy.Policy.Minimum), 1, 6)
-        self.timing_section.addWidget(self.start_delay_label, 1, 7)
-        self.timing_section.addWidget(self.start_delay_input, 1, 8)
-        self.timing_section.addWidget(self.loop_delay_label, 1, 9)
-        self.timing_section.addWidget(self.loop_delay_input, 1, 10)
-        self.timing_section.addWidget(self.delay_type_select, 1, 11)
+        self.timing_section.addWidget(self.snap_label, 1, 6)
+        self.timing_section.addWidget(self.snap_select, 1, 7)
+        self.timing_section.addItem(QSpacerItem(10, 10, QSizePolicy.Policy.MinimumExpanding, QSizePolicy.Policy.Minimum), 1, 8)
+        self.timing_section.addWidget(self.start_delay_label, 1, 9)
+        self.timing_section.addWidget(self.start_delay_input, 1, 10)
+        self.timing_section.addWidget(self.loop_delay_label, 1, 11)
+        self.timing_section.addWidget(self.loop_delay_input, 1, 12)
+        self.timing_section.addWidget(self.delay_type_select, 1, 13)
 
         self.mixer_section.addWidget(self.mixer_drums)
         self.mixer_section.addWidget(self.mixer_bass)
         self.mixer_section.addWidget(self.mixer_vocals)
         self.mixer_section.addWidget(self.mixer_other)
+        self.mixer_section.addWidget(self.mixer_click)
         self.mixer_section.addWidget(self.mixer_master)
 
         self.footer_section.addWidget(self.settings_button)
@@ -287,29 +412,28 @@ class MainWindow(QMainWindow):
 
         # File selection functionality
         self.song_select_button.clicked.connect(self.open_file)
+        self.separation_cancel_button.clicked.connect(self.cancel_separation)
+
+        # Settings that aren't tied to a song
+        self.settings = QSettings("SPT", "SPT")
+
+        # Batch separation functionality
+        # The budget is kept in GiB, bytes don't fit the integers of the settings file
+        budget = self.settings.value("cache_budget", DEFAULT_BUDGET / 1024**3, type=float)
+        self.stem_cache = StemCache(budget=int(budget * 1024**3))
+        self.cache_budget_action.triggered.connect(self.change_cache_budget)
+        self.separation_queue = SeparationQueue(self.stem_cache, parent=self)
+        self.separation_queue.queueChanged.connect(self.update_queue_status)
+        self.separation_queue.songSeparated.connect(self.queue_song_separated)
+        self.queue_files_button.clicked.connect(self.queue_files)
+        self.queue_folder_button.clicked.connect(self.queue_folder)
+        self.queue_cancel_button.clicked.connect(self.separation_queue.cancel)
+        self.queue_clear_button.clicked.connect(self.separation_queue.clearFinished)
         
         # Audio functionality
-        # FIXME: These should probably be objects that have a player, audio output,
-        #        and mixer track and go into an array
-        self.player_drums = QMediaPlayer()
-        self.player_bass = QMediaPlayer()
-        self.player_vocals = QMediaPlayer()
-        self.player_other = QMediaPlayer()
-
-        self.audio_output_drums = QAudioOutput()
-        self.audio_output_bass = QAudioOutput()
-        self.audio_output_vocals = QAudioOutput()
-        self.audio_output_other = QAudioOutput()
-
-        self.player_drums.setAudioOutput(self.audio_output_drums)
-        self.player_bass.setAudioOutput(self.audio_output_bass)
-        self.player_vocals.setAudioOutput(self.audio_output_vocals)
-        self.player_other.setAudioOutput(self.audio_output_other)
-
-        self.audio_output_drums.setVolume(100)
-        self.audio_output_bass.setVolume(100)
-        self.audio_output_vocals.setVolume(100)
-        self.audio_output_other.setVolume(100)
+        # All stems play through one engine, in the order of Separation.STEMS
+        self.engine = AudioEngine(len(Separation.STEMS))
+        self.track_mixers = [self.mixer_drums, self.mixer_bass, self.mixer_vocals, self.mixer_other]
 
         # FIXME: Add track soloing functionality
         self.mixer_drums.volumeChanged.connect(self.volume_changed)
@@ -324,6 +448,8 @@ class MainWindow(QMainWindow):
         self.mixer_other.volumeChanged.connect(self.volume_changed)
         self.mixer_other.trackMuted.connect(self.track_muted)
         # self.mixer_other.trackSoloed.connect(self.track_soloed)
+        self.mixer_click.volumeChanged.connect(self.volume_changed)
+        self.mixer_click.trackMuted.connect(self.track_muted)
         self.mixer_master.volumeChanged.connect(self.volume_changed)
         self.mixer_master.trackMuted.connect(self.track_muted)
 
@@ -332,34 +458,80 @@ class MainWindow(QMainWindow):
         self.media_ctrl_back.clicked.connect(self.skip_backward)
         self.media_ctrl_fwd.clicked.connect(self.skip_forward)
 
-        self.player_other.durationChanged.connect(self.update_duration)
-        self.player_other.positionChanged.connect(self.update_current_position)
-        self.player_other.playbackStateChanged.connect(self.update_playback_state)
+        self.engine.durationChanged.connect(self.update_duration)
+        self.engine.positionChanged.connect(self.update_current_position)
+        self.engine.playbackStateChanged.connect(self.update_playback_state)
 
         # Speed control functionality
         self.speed_ctrl_slider.setValue(50)
         self.speed_ctrl_slider.valueChanged.connect(self.update_playback_speed)
+        self.transpose_input.valueChanged.connect(self.engine.setPitch)
+
+        # Beat grid functionality
+        self.bpm_input.valueChanged.connect(self.update_beat_grid)
+        self.bpm_offset_input.valueChanged.connect(self.update_beat_grid)
+        self.bpm_input.valueChanged.connect(self.tempo_edited)
+        self.bpm_offset_input.valueChanged.connect(self.tempo_edited)
+
+        # Metronome functionality
+        self.metronome_play_button.clicked.connect(self.toggle_metronome)
+        self.metronome_sync_button.clicked.connect(self.sync_metronome)
+
+        # The engine inserts the loop delay itself so the loop stays sample accurate
+        self.loop_delay_input.valueChanged.connect(self.engine.setLoopDelay)
         for button, speed in self.speed_ctrl_buttons:
             button.clicked.connect((lambda speed: lambda: self.set_playback_speed(speed))(speed)) # lambda magic
 
         # Checkpoint functionality
         for i, buttons in enumerate(self.checkpoint_buttons):
-            buttons[0].clicked.connect((lambda i: lambda: self.set_checkpoint(i, self.player_other.position()))(i))
+            buttons[0].clicked.connect((lambda i: lambda: self.set_checkpoint(i, self.engine.position()))(i))
             buttons[1].clicked.connect((lambda i: lambda: self.load_checkpoint(i))(i))
         
         self.media_ctrl_ld_back.clicked.connect(self.load_previous_checkpoint)
         self.media_ctrl_ld_fwd.clicked.connect(self.load_next_checkpoint)
 
+        self.markers = MarkerStore()
+        self.marker_add_button.clicked.connect(self.add_marker)
+        self.marker_bars_button.clicked.connect(self.toggle_bar_markers)
+        self.marker_delete_button.clicked.connect(self.delete_marker)
+        self.marker_rename_button.clicked.connect(self.rename_marker)
+
+        # Session functionality
+        self.session_writer = Session.SessionWriter()
+        self.session_timer = QTimer(self)
+        self.session_timer.setSingleShot(True)
+        self.session_timer.setInterval(self.session_save_delay)
+        self.session_timer.timeout.connect(self.save_session)
+
+        # Any change to the practice setup is saved a moment later
+        for signal in (
+            self.speed_ctrl_slider.valueChanged,
+            self.transpose_input.valueChanged,
+            self.start_delay_input.valueChanged,
+            self.loop_delay_input.valueChanged,
+            self.delay_type_select.currentIndexChanged,
+            self.bpm_input.valueChanged,
+            self.bpm_offset_input.valueChanged,
+            self.snap_select.currentIndexChanged,
+        ):
+            signal.connect(self.schedule_session_save)
+        for mixer in self.session_mixers():
+            mixer.volumeChanged.connect(self.schedule_session_save)
+            mixer.trackMuted.connect(self.schedule_session_save)
+            mixer.trackSoloed.connect(self.schedule_session_save)
+
         # Tracker functionality
-        self.tracker = TrackerWidget([self.player_drums, self.player_bass, self.player_vocals, self.player_other])
+        self.tracker = TrackerWidget()
         self.tracker.setBackgroundColor(self.palette().base().color())
         self.tracker.setForegroundColor(self.palette().highlight().color())
         self.tracker.setFixedHeight(100)
+        self.tracker.setMarkers(self.markers)
 
-        self.player_other.sourceChanged.connect(self.update_source)
+        self.engine.sourceChanged.connect(self.update_source)
         self.tracker_section.addWidget(self.tracker)
 
         self.tracker.trackerMoved.connect(self.change_position)
+        self.tracker.peaksSaved.connect(self.measure_stems)
 
         self.tracker_current_label = QLabel("00:00.00")
         self.tracker_label_spacer = QSpacerItem(10, 10, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
@@ -372,23 +544,38 @@ class MainWindow(QMainWindow):
 
         self.soundwave_select.activated.connect(self.change_wavefrom_display)
 
+    def closeEvent(self, e):
+        self.tracker.stopAnalysis(wait=True)
+        self.engine.stopRendering()
+        self.save_session()
+        self.session_writer.flush()
+        if self.beat_worker is not None:
+            self.beat_worker.wait()
+        if self.mix_decoder is not None:
+            self.mix_decoder.requestInterruption()
+            self.mix_decoder.wait()
+        super().closeEvent(e)
+
     def update_source(self):
         # FIXME: This function probably shouldn't handle all of this functionality
         self.loop = None
         self.tracker.removeLoop()
-        self.checkpoints = {}
-        self.tracker.removeCheckpoints()
+        self.markers.clear()
+        self.tracker.updateMarkers()
         self.media_ctrl_loop.setHighlighted(False)
+        self.marker_bars_button.setHighlighted(False)
         for button in self.checkpoint_buttons:
             button[1].setEnabled(False)
             button[1].setHighlighted(False)
-        self.tracker.update_source()
+        self.tracker.update_source(self.engine.stemStore())
 
     def toggle_loop(self):
         if self.loop is not None:
             self.loop = None
+            self.engine.clearLoop()
             self.tracker.removeLoop()
             self.media_ctrl_loop.setHighlighted(False)
+            self.schedule_session_save()
             return
 
         prev_checkpoint = self.get_previous_checkpoint(250)
@@ -396,65 +583,407 @@ class MainWindow(QMainWindow):
 
         loop_start = prev_checkpoint if prev_checkpoint is not None else 0
         loop_end = next_checkpoint if next_checkpoint is not None else self.media_duration
-        
+
+        # Snapping can't be allowed to close the loop
+        if self.snap_position(loop_start) < self.snap_position(loop_end):
+            loop_start = self.snap_position(loop_start)
+            loop_end = self.snap_position(loop_end)
+
         self.media_ctrl_loop.setHighlighted(True)
         self.loop = (loop_start, loop_end)
+        self.engine.setLoop(*self.loop)
         self.tracker.setLoop(self.loop)
+        self.schedule_session_save()
 
     def change_wavefrom_display(self, index):
-        self.tracker.track_to_graph = index - 1
-        self.tracker.update_audio_data()
+        self.tracker.setTrackToGraph(index - 1)
 
     def open_file(self):
-        file_name = QFileDialog.getOpenFileName(self, caption="Open Audio File", filter="Audio Files (*.mp3 *.wav *.ogg *.opus *.m4a)")
+        file_name = QFileDialog.getOpenFileName(self, caption="Open Audio File", filter="Audio Files (*.mp3 *.wav *.ogg *.opus *.m4a *.flac)")
 
         if not path.isfile(file_name[0]):
             print("Error: Could not open file")
             return
 
-        if len(file_name[0]) < 30:
-            readable_filename = file_name[0]
+        file_name = file_name[0]
+        profiles = self.separation_modes[self.separation_mode_select.currentIndex()][1]
+
+        # Sessions belong to the song, whichever stems of it are loaded
+        quality = Separation.PROFILES["quality"]
+        session_key = self.stem_cache.key(file_name, quality.model, quality.options())
+
+        # Cache hits skip demucs even if the song was moved or renamed.
+        # The best stems already there are loaded, only better ones are made.
+        for i in reversed(range(len(profiles))):
+            profile = Separation.PROFILES[profiles[i]]
+            key, separated_dir, cached = self.stem_cache.lookup(file_name, profile.model, profile.options())
+            if cached:
+                self.cancel_separation()
+                self.load_song(file_name, key, separated_dir, session_key)
+                profiles = profiles[i + 1:]
+                break
+
+        else:
+            # Nothing is separated yet, the original plays in the meantime
+            self.load_original(file_name, session_key)
+
+        if len(profiles) > 0:
+            self.separate_song(file_name, session_key, profiles)
+
+    def separate_song(self, file_name, session_key, profiles):
+        """
+        Separate a song with each profile in turn, the stems of every
+        profile replace those of the one before
+        """
+        profile = Separation.PROFILES[profiles[0]]
+        key = self.stem_cache.key(file_name, profile.model, profile.options())
+
+        # Only one separation at a time, the newest request wins
+        if self.separation_job is None or self.separation_job.key != key:
+            self.cancel_separation()
+
+        self.separation_pending = profiles[1:]
+        self.separation_session_key = session_key
+
+        # The song is being separated like this already
+        if self.separation_job is not None:
+            return
+
+        # A song the queue is separating is followed there instead of starting demucs twice
+        queued = self.separation_queue.job(key)
+        if queued is not None:
+            self.separation_job = queued
+        else:
+            # A song that is playing keeps a core for the audio
+            jobs, threads = Separation.split_cores(reserved_cores=1 if self.engine.stemStore() is not None else 0)
+            self.separation_job = SeparationJob(file_name, key, profile, threads=threads, jobs=jobs, parent=self)
+            self.separation_queue.reserve(key)
+
+        self.separation_job.progressChanged.connect(self.update_separation_progress)
+        self.separation_job.finished.connect((lambda job: lambda directory: self.separation_finished(job, directory))(self.separation_job))
+        self.separation_job.failed.connect((lambda job: lambda message: self.separation_failed(job, message))(self.separation_job))
+
+        self.update_separation_progress(self.separation_job.progress)
+        self.separation_label.setVisible(True)
+        self.separation_cancel_button.setVisible(True)
+
+        if queued is None:
+            self.separation_job.start()
+
+    def cancel_separation(self):
+        job = self.separation_job
+        if job is None:
+            return
+
+        # The job reports back once it has stopped, a song of the queue carries on there
+        self._clear_separation_job()
+        if not self.is_queued(job):
+            job.cancel()
+
+    def is_queued(self, job):
+        return job.parent() is self.separation_queue
+
+    def update_separation_progress(self, progress):
+        if self.separation_job is None:
+            return
+        self.separation_label.setText(f"Separating {path.basename(self.separation_job.file_name)} ({self.separation_job.profile.name})... {progress}%")
+
+    def separation_finished(self, job, separated_dir):
+        # Cached first, so the queue finds the stems once it's released
+        self.stem_cache.add(job.key, job.model)
+        self.release_separation(job)
+        self.drop_separation(job)
+        if job is not self.separation_job:
+            return
+
+        pending = self.separation_pending
+        session_key = self.separation_session_key
+
+        self._clear_separation_job()
+
+        # Better stems of the song that is playing take over where it is
+        if job.file_name == self.media_filename and self.engine.stemStore() is not None:
+            self.replace_stems(job.key, separated_dir)
+        else:
+            self.load_song(job.file_name, job.key, separated_dir, session_key)
+
+        if len(pending) > 0:
+            self.separate_song(job.file_name, session_key, pending)
+
+    def separation_failed(self, job, message):
+        self.release_separation(job)
+        self.drop_separation(job)
+        if job is not self.separation_job:
+            return
+
+        print(f"Error: {message}")
+        self._clear_separation_job()
+
+    def release_separation(self, job):
+        # The queue may separate the song again, unless a newer job of the window does
+        if self.is_queued(job) or (self.separation_job is not job and self.separation_job is not None and self.separation_job.key == job.key):
+            return
+        self.separation_queue.release(job.key)
+
+    def drop_separation(self, job):
+        # Jobs are cleaned up once they've stopped, those of the queue there
+        if not self.is_queued(job):
+            job.deleteLater()
+
+    def _clear_separation_job(self):
+        self.separation_job = None
+        self.separation_pending = []
+        self.separation_session_key = None
+        self.separation_label.setVisible(False)
+        self.separation_cancel_button.setVisible(False)
+
+    def queue_files(self):
+        file_names = QFileDialog.getOpenFileNames(self, caption="Queue Audio Files", filter="Audio Files (*.mp3 *.wav *.ogg *.opus *.m4a *.flac)")
+        self.separation_queue.addFiles(file_names[0])
+
+    def queue_folder(self):
+        directory = QFileDialog.getExistingDirectory(self, caption="Queue Folder")
+
+        if not path.isdir(directory):
+            return
+
+        self.separation_queue.addDirectory(directory)
+
+    def update_queue_status(self):
+        total = self.separation_queue.count()
+        done = self.separation_queue.count("done")
+        failed = self.separation_queue.count("failed")
+
+        # Finished songs are listed until they're cleared
+        self.queue_label.setVisible(total > 0)
+        self.queue_cancel_button.setVisible(done + failed < total)
+        self.queue_clear_button.setVisible(done + failed > 0)
+        if total == 0:
+            return
+
+        self.queue_label.setText(f"Queue: {done}/{total}" + (f", {failed} failed" if failed > 0 else ""))
+
+    def queue_song_separated(self, file_name, key, separated_dir):
+        # A song followed from the queue is loaded once its job finishes
+        if self.separation_job is not None and self.separation_job.key == key:
+            return
+        if path.abspath(self.media_filename) != file_name:
+            return
+
+        # The queue makes the best stems there are, they replace those of the open song
+        self.cancel_separation()
+        self.replace_stems(key, separated_dir)
+
+    def change_cache_budget(self):
+        budget, accepted = QInputDialog.getDouble(
+            self, "Stem Cache Size", "GiB of stems kept, the songs played longest ago are removed past it:",
+            self.stem_cache.budget / 1024**3, 0.1, 10000, 1,
+        )
+        if not accepted:
+            return
+
+        self.stem_cache.budget = int(budget * 1024**3)
+        self.settings.setValue("cache_budget", budget)
+        self.stem_cache.evict()
+
+    def load_song(self, file_name, key, separated_dir, session_key=None):
+        """
+        key: Cache key of the stems
+        session_key: Key the session of the song is stored under, key if None
+        """
+        try:
+            stem_store = StemStore(Separation.stem_paths(separated_dir))
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not open stems. {e}")
+            return
+
+        self.stop_decoding()
+        self.open_song(file_name, stem_store, key, separated_dir, session_key)
+
+    def load_original(self, file_name, session_key):
+        """
+        Play the song as it is, mixed down by the stem tracks, until it's separated
+        """
+        self.stop_decoding()
+
+        from MixDecoder import MixDecoder
+
+        try:
+            self.mix_decoder = MixDecoder(file_name, len(Separation.STEMS), parent=self)
+        except (ImportError, RuntimeError, OSError) as e:
+            print(f"Warning: {path.basename(file_name)} can only be played once it's separated. {e}")
+            return
+
+        self.mix_decoder.finished.connect((lambda decoder: lambda: self.original_decoded(decoder))(self.mix_decoder))
+        self.mix_decoder.failed.connect(lambda message: print(f"Error: {message}"))
+        self.mix_decoder.start()
+
+        self.open_song(file_name, self.mix_decoder.store, None, "", session_key)
+
+    def original_decoded(self, decoder):
+        decoder.deleteLater()
+        if decoder is not self.mix_decoder:
+            return
+
+        self.mix_decoder = None
+
+        # Picks up the decoded length, playback carries on undisturbed
+        if self.engine.stemStore() is decoder.store:
+            self.engine.updateDuration()
+            self.tracker.update_source(decoder.store)
+
+    def stop_decoding(self):
+        if self.mix_decoder is not None:
+            self.mix_decoder.requestInterruption()
+            self.mix_decoder = None
+
+    def open_song(self, file_name, stem_store, key, separated_dir, session_key=None):
+        """
+        key: Cache key of the stems, None for the original mix
+        separated_dir: Directory of the stems, empty for the original mix
+        """
+        if len(file_name) < 30:
+            readable_filename = file_name
         else:
-            readable_filename = path.basename(file_name[0])
+            readable_filename = path.basename(file_name)
 
         self.song_select_label.setText(readable_filename)
 
-        self.media_filename = file_name[0]
-    
+        # The song being left keeps its latest changes
+        self.save_session()
+
+        self.media_filename = file_name
+        self.media_separated_dir = separated_dir
+        self.media_key = session_key if session_key is not None else key
+        self.media_stem_key = key
+        self.stem_cache.pinned = {key} if key is not None else set()
+
         self.song_select_label.setFont(QFont("sans-serif", False))
 
         new_window_title = f"{self.window_title} - {path.splitext(readable_filename)[0]}"
         self.setWindowTitle(new_window_title)
 
-        # Separate audio
-        # FIXME: Don't do this here, use a worker
-        model = "htdemucs_ft"
-        self.media_separated_dir = f"separated/{model}/{path.splitext(path.basename(file_name[0]))[0]}/"
-        if not path.exists(self.media_separated_dir):
-            demucs.separate.main(["-n", model, self.media_filename])
+        self.engine.setSource(stem_store)
+        self.restore_session()
 
-        self.player_drums.setSource(QUrl.fromLocalFile(self.media_separated_dir + "drums.wav"))
-        self.player_bass.setSource(QUrl.fromLocalFile(self.media_separated_dir + "bass.wav"))
-        self.player_vocals.setSource(QUrl.fromLocalFile(self.media_separated_dir + "vocals.wav"))
-        self.player_other.setSource(QUrl.fromLocalFile(self.media_separated_dir + "other.wav"))
+        # Beats are found on the drums once there are stems
+        self.beat_grid = None
+        self.update_beat_grid()
+        if separated_dir != "":
+            self.detect_beats(stem_store, separated_dir)
 
-    
-    def get_previous_checkpoint(self, threshold):
+    def replace_stems(self, key, separated_dir):
+        try:
+            stem_store = StemStore(Separation.stem_paths(separated_dir))
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not open stems. {e}")
+            return
+
+        self.stop_decoding()
+        was_original = self.media_separated_dir == ""
+        self.media_separated_dir = separated_dir
+        self.media_stem_key = key
+        self.stem_cache.pinned = {key}
+
+        # Markers, loop and settings stay, only the audio changes
+        self.engine.replaceSource(stem_store)
+        self.tracker.update_source(stem_store)
+
+        if was_original:
+            self.detect_beats(stem_store, separated_dir)
+
+    def detect_beats(self, stem_store, separated_dir):
+        # Onsets are clearest on the isolated drums
+        stem = stem_store[Separation.STEMS.index("drums")]
+        from BeatWorker import BeatWorker
+        self.beat_worker = BeatWorker(stem, separated_dir, parent=self)
+        self.beat_worker.detected.connect((lambda worker: lambda grid: self.beats_detected(worker, grid))(self.beat_worker))
+        self.beat_worker.finished.connect(self.beat_worker.deleteLater)
+        self.beat_worker.start()
+
+    def measure_stems(self):
+        # Peaks and beats saved next to the stems count towards the cache size
+        if self.media_stem_key is not None:
+            self.stem_cache.measure(self.media_stem_key)
+
+    def beats_detected(self, worker, grid):
+        if worker is not self.beat_worker:
+            return
+
+        self.beat_worker = None
+        self.measure_stems()
+        if len(grid) == 0:
+            return
+
+        self.beat_grid = grid
+
+        # A tempo from the session or typed in was set on purpose
+        if self.tempo_source != "user":
+            self.set_tempo(round(grid.bpm), grid.offset(), "detected")
+        self.update_beat_grid()
+
+    def set_tempo(self, bpm, offset, source):
+        self._setting_tempo = True
+        self.bpm_input.setValue(bpm)
+        self.bpm_offset_input.setValue(offset)
+        self._setting_tempo = False
+        self.tempo_source = source
+
+    def tempo_edited(self):
+        if not self._setting_tempo:
+            self.tempo_source = "user"
+
+    def update_beat_grid(self):
+        from BeatTracker import BeatGrid
+
+        bpm = self.bpm_input.value()
+        offset = self.bpm_offset_input.value()
+
+        # The detected beats follow tempo changes, they're kept until the fields are edited
+        if self.beat_grid is not None and round(self.beat_grid.bpm) == bpm and self.beat_grid.offset() == offset:
+            self.active_beat_grid = self.beat_grid
+        else:
+            self.active_beat_grid = BeatGrid.from_tempo(bpm, offset, self.media_duration / 1000)
+
+        self.engine.setClickGrid(self.active_beat_grid)
+
+    def toggle_metronome(self):
+        self.metronome_enabled = not self.metronome_enabled
+        self.schedule_session_save()
+
+        if self.metronome_enabled:
+            self.metronome_play_button.setIcon(QIcon.fromTheme("media-pause"))
+            self.metronome_play_button.setToolTip("Stop metronome")
+        else:
+            self.metronome_play_button.setIcon(QIcon.fromTheme("media-play"))
+            self.metronome_play_button.setToolTip("Start metronome")
+
+        self.update_volumes()
+
+    def sync_metronome(self):
+        # Back to the detected beats after the fields were edited
+        if self.beat_grid is None:
+            return
+
+        self.set_tempo(round(self.beat_grid.bpm), self.beat_grid.offset(), "detected")
+
+    def snap_position(self, position):
         """
-        threshold: Number of milliseconds in which the checkpoint will not be counted
+        position: Milliseconds, snapped to the nearest beat or bar depending on the snap mode
         """
-        current_pos = self.player_other.position()
-        min_diff = math.inf
-        prev_checkpoint = None
+        mode = self.snap_select.currentText()
+        if mode == "Off" or self.active_beat_grid is None:
+            return position
 
-        for checkpoint in self.checkpoints.values():
-            if current_pos - checkpoint < threshold:
-                continue
-            if (current_pos - checkpoint) < min_diff:
-                min_diff = (current_pos - checkpoint)
-                prev_checkpoint = checkpoint
+        snapped = int(round(self.active_beat_grid.snap(position / 1000, bars=mode == "Bar") * 1000))
+        return min(max(snapped, 0), self.media_duration)
 
-        return prev_checkpoint
+    def get_previous_checkpoint(self, threshold):
+        """
+        threshold: Number of milliseconds in which the checkpoint will not be counted
+        """
+        marker = self.markers.previous(self.engine.position(), threshold)
+        return marker.position if marker is not None else None
 
     def load_previous_checkpoint(self):
         prev_checkpoint = self.get_previous_checkpoint(250)
@@ -462,27 +991,14 @@ class MainWindow(QMainWindow):
         if prev_checkpoint is None:
             prev_checkpoint = 0
 
-        self.player_drums.setPosition(prev_checkpoint)
-        self.player_bass.setPosition(prev_checkpoint)
-        self.player_vocals.setPosition(prev_checkpoint)
-        self.player_other.setPosition(prev_checkpoint)
+        self.engine.setPosition(prev_checkpoint)
 
     def get_next_checkpoint(self, threshold):
         """
         threshold: Number of milliseconds in which the checkpoint will not be counted
         """
-        current_pos = self.player_other.position()
-        min_diff = math.inf
-        next_checkpoint = None
-
-        for checkpoint in self.checkpoints.values():
-            if checkpoint - current_pos < threshold:
-                continue
-            if (checkpoint - current_pos) < min_diff:
-                min_diff = (checkpoint - current_pos)
-                next_checkpoint = checkpoint
-        
-        return next_checkpoint
+        marker = self.markers.next(self.engine.position(), threshold)
+        return marker.position if marker is not None else None
 
     def load_next_checkpoint(self):
         next_checkpoint = self.get_next_checkpoint(250)
@@ -490,32 +1006,159 @@ class MainWindow(QMainWindow):
         if next_checkpoint is None:
             next_checkpoint = self.media_duration
 
-        self.player_drums.setPosition(next_checkpoint)
-        self.player_bass.setPosition(next_checkpoint)
-        self.player_vocals.setPosition(next_checkpoint)
-        self.player_other.setPosition(next_checkpoint)
+        self.engine.setPosition(next_checkpoint)
 
     def load_checkpoint(self, index):
-        if self.checkpoints[index] is not None:
-            self.player_drums.setPosition(self.checkpoints[index])
-            self.player_bass.setPosition(self.checkpoints[index])
-            self.player_vocals.setPosition(self.checkpoints[index])
-            self.player_other.setPosition(self.checkpoints[index])
+        marker = self.markers.slot(index)
+        if marker is not None:
+            self.engine.setPosition(marker.position)
 
     def set_checkpoint(self, index, position):
+        position = self.snap_position(position)
+
+        marker = self.markers.slot(index)
+        if marker is not None:
+            self.markers.remove(marker)
+
         # If checkpoint exists in the same position unset it instead
-        if index in self.checkpoints and self.checkpoints[index] == position:
-            del self.checkpoints[index]
-            self.tracker.removeCheckpoint(index)
+        if marker is not None and marker.position == position:
+            self.tracker.updateMarkers()
             self.checkpoint_buttons[index][1].setEnabled(False)
             self.checkpoint_buttons[index][1].setHighlighted(False)
+            self.schedule_session_save()
             return
 
         # Otherwise set the checkpoint
-        self.checkpoints[index] = position
-        self.tracker.addCheckpoint(index, position, QColor.fromString(self.checkpoint_colors[index % len(self.checkpoint_colors)]))
+        color = self.checkpoint_colors[index % len(self.checkpoint_colors)]
+        self.markers.add(Marker(position, color=color, kind="checkpoint", slot=index))
+        self.tracker.updateMarkers()
         self.checkpoint_buttons[index][1].setEnabled(True)
         self.checkpoint_buttons[index][1].setHighlighted(True)
+        self.schedule_session_save()
+
+    def add_marker(self):
+        position = self.snap_position(self.engine.position())
+        count = sum(1 for marker in self.markers if marker.kind == "marker")
+
+        self.markers.add(Marker(position, self._rehearsal_letter(count), self.marker_color))
+        self.tracker.updateMarkers()
+        self.schedule_session_save()
+
+    def marker_at_playhead(self):
+        return self.markers.nearest(self.engine.position(), self.marker_reach)
+
+    def delete_marker(self):
+        marker = self.marker_at_playhead()
+        if marker is None or not self.markers.remove(marker):
+            return
+
+        if marker.slot is not None:
+            self.checkpoint_buttons[marker.slot][1].setEnabled(False)
+            self.checkpoint_buttons[marker.slot][1].setHighlighted(False)
+        self.marker_bars_button.setHighlighted(self.markers.has_kind("bar"))
+        self.tracker.updateMarkers()
+        self.schedule_session_save()
+
+    def rename_marker(self):
+        marker = self.marker_at_playhead()
+        if marker is None:
+            return
+
+        name, accepted = QInputDialog.getText(self, "Rename Marker", "Name:", text=marker.name)
+        if not accepted:
+            return
+
+        marker.name = name
+        self.tracker.updateMarkers()
+        self.schedule_session_save()
+
+    def toggle_bar_markers(self):
+        if self.markers.has_kind("bar"):
+            self.markers.remove_kind("bar")
+            self.marker_bars_button.setHighlighted(False)
+            self.tracker.updateMarkers()
+            self.schedule_session_save()
+            return
+
+        if self.active_beat_grid is None or len(self.active_beat_grid) == 0:
+            return
+
+        downbeats = self.active_beat_grid.downbeats()
+        self.markers.extend(Marker(int(round(time * 1000)), str(i + 1), self.bar_marker_color, "bar") for i, time in enumerate(downbeats))
+        self.marker_bars_button.setHighlighted(True)
+        self.tracker.updateMarkers()
+        self.schedule_session_save()
+
+    def session_mixers(self):
+        return self.track_mixers + [self.mixer_click, self.mixer_master]
+
+    def schedule_session_save(self, *args):
+        if self.media_key is not None:
+            self.session_timer.start()
+
+    def save_session(self):
+        """
+        Hand the current practice setup to the session writer, the file is written off the UI thread
+        """
+        self.session_timer.stop()
+        if self.media_key is None:
+            return
+
+        session = Session.Session()
+        session.loop = self.loop
+        session.speed = self.speed_ctrl_slider.value()
+        session.transpose = self.transpose_input.value()
+        session.start_delay = self.start_delay_input.value()
+        session.loop_delay = self.loop_delay_input.value()
+        session.delay_type = self.delay_type_select.currentIndex()
+        # The default tempo isn't saved, detection fills it in next time
+        if self.tempo_source is not None:
+            session.bpm = self.bpm_input.value()
+            session.bpm_offset = self.bpm_offset_input.value()
+        session.snap = self.snap_select.currentIndex()
+        session.metronome = self.metronome_enabled
+        session.mixers = [(mixer.value(), mixer.muted, mixer.soloed) for mixer in self.session_mixers()]
+        session.markers = list(self.markers)
+
+        self.session_writer.write(self.media_key, session)
+
+    def restore_session(self):
+        self.tempo_source = None
+
+        session = Session.load_session(self.media_key)
+        if session is None:
+            return
+
+        for mixer, (volume, muted, soloed) in zip(self.session_mixers(), session.mixers):
+            mixer.setValue(volume)
+            mixer.setMuted(muted)
+            mixer.setSoloed(soloed)
+
+        self.speed_ctrl_slider.setValue(session.speed)
+        self.transpose_input.setValue(session.transpose)
+        self.start_delay_input.setValue(session.start_delay)
+        self.loop_delay_input.setValue(session.loop_delay)
+        self.delay_type_select.setCurrentIndex(session.delay_type)
+        self.snap_select.setCurrentIndex(session.snap)
+
+        if session.bpm != 0:
+            self.set_tempo(session.bpm, session.bpm_offset, "user")
+
+        if session.metronome != self.metronome_enabled:
+            self.toggle_metronome()
+
+        self.markers.extend(session.markers)
+        self.tracker.updateMarkers()
+        for i, buttons in enumerate(self.checkpoint_buttons):
+            buttons[1].setEnabled(self.markers.slot(i) is not None)
+            buttons[1].setHighlighted(self.markers.slot(i) is not None)
+        self.marker_bars_button.setHighlighted(self.markers.has_kind("bar"))
+
+        if session.loop is not None:
+            self.loop = session.loop
+            self.engine.setLoop(*self.loop)
+            self.tracker.setLoop(self.loop)
+            self.media_ctrl_loop.setHighlighted(True)
 
     def set_playback_speed(self, speed):
         self.speed_ctrl_slider.setValue(self._interpolate_slider_value(speed))
@@ -524,63 +1167,26 @@ class MainWindow(QMainWindow):
         slider_value = self.speed_ctrl_slider.value()
         speed = self._interpolate_playback_speed(slider_value)
 
-        self.player_drums.setPlaybackRate(speed)
-        self.player_bass.setPlaybackRate(speed)
-        self.player_vocals.setPlaybackRate(speed)
-        self.player_other.setPlaybackRate(speed)
+        self.engine.setPlaybackRate(speed)
 
     def skip_forward(self):
-        new_position = self.player_other.position() + 5000
+        new_position = self.engine.position() + 5000
 
         if new_position >= self.media_duration:
             new_position = self.media_duration
         
-        self.player_drums.setPosition(new_position)
-        self.player_bass.setPosition(new_position)
-        self.player_vocals.setPosition(new_position)
-        self.player_other.setPosition(new_position)
+        self.engine.setPosition(new_position)
 
     def skip_backward(self):
-        new_position = self.player_other.position() - 5000
+        new_position = self.engine.position() - 5000
 
         if new_position <= 0:
             new_position = 0
 
-        self.player_drums.setPosition(new_position)
-        self.player_bass.setPosition(new_position)
-        self.player_vocals.setPosition(new_position)
-        self.player_other.setPosition(new_position)
+        self.engine.setPosition(new_position)
 
     def track_muted(self, muted, track):
-        # FIXME: Use audio_output.setMuted for mute
-        match track:
-            case "Drums":
-                if muted == True:
-                    self.audio_output_drums.setVolume(0)
-                else:
-                    self.audio_output_drums.setVolume(self.mixer_drums.value() / 100 * self.master_track_volume)
-            case "Bass":
-                if muted == True:
-                    self.audio_output_bass.setVolume(0)
-                else:
-                    self.audio_output_bass.setVolume(self.mixer_bass.value() / 100 * self.master_track_volume)
-            case "Vocals":
-                if muted == True:
-                    self.audio_output_vocals.setVolume(0)
-                else:
-                    self.audio_output_vocals.setVolume(self.mixer_vocals.value() / 100 * self.master_track_volume)
-            case "Other":
-                if muted == True:
-                    self.audio_output_other.setVolume(0)
-                else:
-                    self.audio_output_other.setVolume(self.mixer_other.value() / 100 * self.master_track_volume)
-            case "Master":
-                if muted == True:
-                    self.master_track_volume = 0
-                    self.volume_changed(0, "Master")
-                else:
-                    self.master_track_volume = (self.mixer_master.value() / 100)
-                    self.volume_changed(self.mixer_master.value(), "Master")
+        self.update_volumes()
 
     def update_playback_state(self, state):
         if state == QMediaPlayer.PlaybackState.PlayingState:
@@ -594,79 +1200,37 @@ class MainWindow(QMainWindow):
             self.media_ctrl_play_pause.setIcon(QIcon.fromTheme("media-play"))
 
     def change_position(self, value):
-        self.player_drums.setPosition(value)
-        self.player_bass.setPosition(value)
-        self.player_vocals.setPosition(value)
-        self.player_other.setPosition(value)
+        self.engine.setPosition(value)
     
     def update_duration(self, duration):
         self.media_duration = duration
+        self.update_beat_grid()
         self.tracker.setMaximum(duration)
         self.tracker_duration_label.setText(self._ms_to_timestamp(duration))
 
     def update_current_position(self, position):
-        # FIXME: This probably loops even when scrubbing the tracker
-        self.check_for_loop(position, 50)
         self.media_position = position
         self.tracker.setTrackerPosition(self.media_position)
         self.tracker_current_label.setText(self._ms_to_timestamp(position))
 
-    def check_for_loop(self, new_position, threshold):
-        """
-        threshold: Range of milliseconds to still count as a loop (half threshold before, and double after the loop point)
-        """
-        if self.loop is None:
-            return
+    def volume_changed(self, value, track):
+        self.update_volumes()
 
-        if new_position in range(self.loop[1] - threshold // 2, self.loop[1] + threshold * 2):
-            # Check for loop delay
-            loop_delay = self.loop_delay_input.value()
-            # FIXME: This should probably stop playback and resume after timer elapses
-            if loop_delay != 0:
-                self.loop_delay_timer.timeout.connect(self._do_loop)
-                self.loop_delay_timer.setInterval(loop_delay * 1000)
-                self.loop_delay_timer.setSingleShot(True)
-                self.loop_delay_timer.start()
-                self.media_ctrl_play_pause.setHighlighted(True)
-                self._pause()
-                return
-
-            self._do_loop()
+    def update_volumes(self):
+        self.master_track_volume = 0 if self.mixer_master.muted else self.mixer_master.value() / 100
 
-    
-    def _do_loop(self):
-        # Paused due to loop delay
-        if self.media_state == "paused":
-            self._play()
+        for i, mixer in enumerate(self.track_mixers):
+            if mixer.muted:
+                self.engine.setVolume(i, 0)
+            else:
+                self.engine.setVolume(i, mixer.value() / 100 * self.master_track_volume)
 
-        self.change_position(self.loop[0])
-    
-    def volume_changed(self, value, track):
-        # FIXME: Use audio_output.setMuted for mute
-        match track:
-            case "Drums":
-                if not self.mixer_drums.muted:
-                    self.audio_output_drums.setVolume(value / 100 * self.master_track_volume)
-            case "Bass":
-                if not self.mixer_bass.muted:
-                    self.audio_output_bass.setVolume(value / 100 * self.master_track_volume)
-            case "Vocals":
-                if not self.mixer_vocals.muted:
-                    self.audio_output_vocals.setVolume(value / 100 * self.master_track_volume)
-            case "Other":
-                if not self.mixer_other.muted:
-                    self.audio_output_other.setVolume(value / 100 * self.master_track_volume)
-            case "Master":
-                self.master_track_volume = value / 100
-
-        if not self.mixer_drums.muted:
-            self.audio_output_drums.setVolume(self.mixer_drums.value() / 100 * self.master_track_volume)
-        if not self.mixer_bass.muted:
-            self.audio_output_bass.setVolume(self.mixer_bass.value() / 100 * self.master_track_volume)
-        if not self.mixer_vocals.muted:
-            self.audio_output_vocals.setVolume(self.mixer_vocals.value() / 100 * self.master_track_volume)
-        if not self.mixer_other.muted:
-            self.audio_output_other.setVolume(self.mixer_other.value() / 100 * self.master_track_volume)
+        if self.metronome_enabled and not self.mixer_click.muted:
+            self.engine.setClickVolume(self.mixer_click.value() / 100 * self.master_track_volume)
+        else:
+            self.engine.setClickVolume(0)
+
+        self.tracker.setTrackGains([self.engine.volume(i) for i in range(len(self.track_mixers))])
 
     def play_pause(self):
         if self.media_state == "inactive":
@@ -698,41 +1262,26 @@ class MainWindow(QMainWindow):
 
     def _play(self):
         self.media_ctrl_play_pause.setHighlighted(False)
-        self.player_drums.play()
-        self.player_bass.play()
-        self.player_vocals.play()
-        self.player_other.play()
+        self.engine.play()
 
     def pause(self):
         # Pause initiated during start delay period
         if self.start_delay_timer.isActive():
             self.media_ctrl_play_pause.setHighlighted(False)
             self.start_delay_timer.stop()
-        # Paude initiated during loop delay period
-        if self.loop_delay_timer.isActive():
-            self.loop_delay_timer.stop()
 
         self.media_state = "paused"
         self.media_ctrl_play_pause.setIcon(QIcon.fromTheme("media-play"))
         self._pause()
 
     def _pause(self):
-        self.player_drums.pause()
-        self.player_bass.pause()
-        self.player_vocals.pause()
-        self.player_other.pause()
+        self.engine.pause()
 
     def restart(self):
         self.media_state = "playing"
         self.media_ctrl_play_pause.setIcon(QIcon.fromTheme("media-pause"))
-        self.player_drums.setPosition(0)
-        self.player_bass.setPosition(0)
-        self.player_vocals.setPosition(0)
-        self.player_other.setPosition(0)
-        self.player_drums.play()
-        self.player_bass.play()
-        self.player_vocals.play()
-        self.player_other.play()
+        self.engine.setPosition(0)
+        self.engine.play()
 
     @staticmethod
     def _interpolate_playback_speed(slider_value):
@@ -756,6 +1305,12 @@ class MainWindow(QMainWindow):
 
         return int(slider_value)
         
+    @staticmethod
+    def _rehearsal_letter(index):
+        # A to Z, then A2 to Z2 and so on
+        letter = chr(ord("A") + index % 26)
+        return letter if index < 26 else f"{letter}{index // 26 + 1}"
+
     @staticmethod
     def _ms_to_timestamp(ms):
         minutes = ms // 60000
@@ -764,10 +1319,48 @@ class MainWindow(QMainWindow):
         return f"{minutes:02d}:{seconds:02d}.{millies:02d}"
 
 
+class _StartupTimer(QObject):
+    """
+    Prints the time spent in each step of starting up, once the window
+    has been painted for the first time
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.steps = [("start", startup_time)]
+
+    def step(self, name):
+        self.steps.append((name, time.perf_counter()))
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint:
+            obj.removeEventFilter(self)
+            self.step("first paint")
+            self.report()
+        return False
+
+    def report(self):
+        times = [f"{name} {(end - start) * 1000:.0f} ms" for (_, start), (name, end) in zip(self.steps, self.steps[1:])]
+        total = (self.steps[-1][1] - self.steps[0][1]) * 1000
+        print(f"Startup: {', '.join(times)}, window shown after {total:.0f} ms")
+
+
 def main():
+    timer = _StartupTimer() if os.environ.get("SPT_STARTUP_TIMING") else None
+    if timer is not None:
+        timer.step("imports")
+
     app = QApplication(sys.argv)
 
+    if timer is not None:
+        timer.step("application")
+
     window = MainWindow()
+
+    if timer is not None:
+        timer.step("window")
+        window.installEventFilter(timer)
+
     window.show()
 
     app.exec()